@@ -0,0 +1,434 @@
+import os
+import sys
+import json
+import time
+import types
+import zlib
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+FIXTURES_FILE = os.path.join(BENCHMARK_DIR, 'fixtures.json')
+SESSIONS_DIR = os.path.join(BENCHMARK_DIR, 'sessions')
+HEADLINE_STAGES = ('first audio', 'transition gap')  # Compared against --baseline
+
+# Config written into each session's scratch directory
+BENCHMARK_CONFIG = {
+    'live_status': False,
+    'audio_cache_enabled': False,
+    'db_flush_interval': 0.2,
+    'loudness_normalization': False,  # Analysis runs in spawned processes, which the fake backends do not reach
+    'throughput_probe_bytes': 0,  # The fake stream URLs are not served anywhere
+}
+
+fixtures = None
+latency_rng = random.Random(0)
+latency_lock = threading.Lock()
+
+# Sleep for a recorded stage latency, jittered so percentiles have some spread
+def simulate_latency(stage):
+    with latency_lock:
+        jitter = latency_rng.uniform(0.8, 1.25)
+    time.sleep(fixtures['latency_ms'][stage] * jitter / 1000)
+
+def fixture_search(query):
+    videos = fixtures['searches'].get(' '.join(query.lower().split()))
+    if videos is None:
+        # Unrecorded queries get stable made-up results
+        videos = [{'id': f"q{zlib.crc32(query.encode()):010d}{i}", 'title': f"{query} ({i + 1})"} for i in range(5)]
+    return videos
+
+# Fake googleapiclient: answers search, playlistItems and playlists requests from the fixtures
+class FakeRequest:
+    def __init__(self, respond):
+        self.respond = respond
+        self.headers = {}
+
+    def execute(self, http=None, num_retries=0):
+        simulate_latency('api_request')
+        return self.respond()
+
+class FakeResource:
+    def __init__(self, respond):
+        self.respond = respond
+
+    def list(self, **kwargs):
+        return FakeRequest(lambda: self.respond(**kwargs))
+
+def search_response(q, **kwargs):
+    return {'items': [{'id': {'videoId': video['id']}, 'snippet': {'title': video['title']}} for video in fixture_search(q)]}
+
+def playlist_items_response(playlistId, pageToken=None, **kwargs):
+    videos = fixtures['playlists'][playlistId]['videos']
+    size = fixtures['playlist_page_size']
+    start = int(pageToken or 0)
+    response = {
+        'etag': f"{playlistId}-{start}",
+        'items': [{'snippet': {'title': video['title'], 'resourceId': {'videoId': video['id']}}} for video in videos[start:start + size]],
+    }
+    if start + size < len(videos):
+        response['nextPageToken'] = str(start + size)
+    return response
+
+def playlists_response(id, **kwargs):
+    return {'etag': id, 'items': [{'snippet': {'title': fixtures['playlists'][id]['title']}}]}
+
+def videos_response(id, **kwargs):
+    known = {video['id']: video['title'] for videos in fixtures['searches'].values() for video in videos}
+    known.update((video['id'], video['title']) for playlist in fixtures['playlists'].values() for video in playlist['videos'])
+    duration = f"PT{fixtures['track_ms'] // 1000}S"
+    return {'items': [{'id': video_id, 'snippet': {'title': known[video_id], 'channelTitle': 'Benchmark'}, 'contentDetails': {'duration': duration}}
+                      for video_id in id.split(',') if video_id in known]}
+
+class FakeYoutube:
+    def search(self):
+        return FakeResource(search_response)
+
+    def videos(self):
+        return FakeResource(videos_response)
+
+    def playlistItems(self):
+        return FakeResource(playlist_items_response)
+
+    def playlists(self):
+        return FakeResource(playlists_response)
+
+class FakeHttpError(Exception):
+    def __init__(self, resp, content=b''):
+        super().__init__(resp, content)
+        self.resp = resp
+
+class FakeHttp:
+    def __init__(self, *args, **kwargs):
+        pass
+
+# Fake yt_dlp: resolves any watch URL to a stream URL after the recorded extraction latency
+class FakeYoutubeDL:
+    def __init__(self, params=None):
+        self.params = params or {}
+
+    def extract_info(self, url, download=False):
+        simulate_latency('extract')
+        video_id = url.split('v=')[-1]
+        expire = int(time.time()) + 21600
+        formats = [dict(audio_format, url=f"https://bench.invalid/{video_id}/{audio_format['format_id']}?expire={expire}")
+                   for audio_format in fixtures['formats']]
+        return {'id': video_id, 'formats': formats, 'url': formats[-1]['url']}
+
+# Fake python-vlc: plays a fixed-length track on a timeline thread and fires the events the player listens to
+class FakeEventType:
+    MediaPlayerEndReached = 'end'
+    MediaPlayerTimeChanged = 'time'
+    MediaPlayerLengthChanged = 'length'
+    MediaPlayerPlaying = 'playing'
+    MediaPlayerPaused = 'paused'
+    MediaPlayerStopped = 'stopped'
+    MediaPlayerBuffering = 'buffering'
+    MediaPlayerEncounteredError = 'error'
+
+class FakeState:
+    Playing = 3
+    Paused = 4
+    Stopped = 5
+
+class FakeMedia:
+    def __init__(self, mrl):
+        self.mrl = mrl
+        self.start_paused = False
+
+    def get_mrl(self):
+        return self.mrl
+
+    def add_option(self, option):
+        if option == ':start-paused':
+            self.start_paused = True
+
+    def release(self):
+        pass
+
+class FakeEventManager:
+    def __init__(self):
+        self.handlers = {}
+
+    def event_attach(self, event_type, callback, *args):
+        self.handlers.setdefault(event_type, []).append((callback, args))
+
+    def fire(self, event_type, **values):
+        event = types.SimpleNamespace(type=event_type, u=types.SimpleNamespace(**values))
+        for callback, args in self.handlers.get(event_type, []):
+            callback(event, *args)
+
+class FakeMediaPlayer:
+    def __init__(self):
+        self.events = FakeEventManager()
+        self.media = None
+        self.playing = False
+        self.paused = False
+        self.time_ms = 0
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def event_manager(self):
+        return self.events
+
+    def set_media(self, media):
+        with self.lock:
+            self.generation += 1
+            self.playing = False
+            self.paused = False
+        self.media = media
+
+    def get_media(self):
+        return self.media
+
+    def play(self):
+        with self.lock:
+            if self.paused:
+                self.paused = False
+                self.events.fire(FakeEventType.MediaPlayerPlaying)
+                return 0
+            self.generation += 1
+            self.playing = True
+            self.time_ms = 0
+            generation = self.generation
+        threading.Thread(target=self.run_timeline, args=(generation, self.media), daemon=True).start()
+        return 0
+
+    def run_timeline(self, generation, media):
+        simulate_latency('vlc_open')
+        track_ms = fixtures['track_ms']
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.events.fire(FakeEventType.MediaPlayerBuffering, new_cache=100.0)
+            # ':start-paused' opens and buffers the media, then waits for play()
+            self.paused = media.start_paused
+            self.events.fire(FakeEventType.MediaPlayerPaused if media.start_paused else FakeEventType.MediaPlayerPlaying)
+            self.events.fire(FakeEventType.MediaPlayerLengthChanged, new_length=track_ms)
+        while True:
+            time.sleep(0.25)
+            with self.lock:
+                if generation != self.generation:
+                    return
+                if self.paused:
+                    continue
+                self.time_ms = min(track_ms, self.time_ms + 250)
+                self.events.fire(FakeEventType.MediaPlayerTimeChanged, new_time=self.time_ms)
+                if self.time_ms >= track_ms:
+                    self.playing = False
+                    self.generation += 1
+                    self.events.fire(FakeEventType.MediaPlayerEndReached)
+                    return
+
+    def pause(self):
+        with self.lock:
+            self.paused = not self.paused
+            self.events.fire(FakeEventType.MediaPlayerPaused if self.paused else FakeEventType.MediaPlayerPlaying)
+
+    def stop(self):
+        with self.lock:
+            self.generation += 1
+            self.playing = False
+            self.paused = False
+            self.events.fire(FakeEventType.MediaPlayerStopped)
+
+    def is_playing(self):
+        return self.playing and not self.paused
+
+    def get_state(self):
+        if not self.playing:
+            return FakeState.Stopped
+        return FakeState.Paused if self.paused else FakeState.Playing
+
+    def get_time(self):
+        return self.time_ms
+
+    def set_time(self, time_ms):
+        self.time_ms = time_ms
+
+    def get_length(self):
+        return fixtures['track_ms']
+
+    def audio_set_volume(self, volume):
+        return 0
+
+    def set_equalizer(self, equalizer):
+        return 0
+
+    def release(self):
+        self.stop()
+
+class FakeInstance:
+    def __init__(self, *args):
+        pass
+
+    def media_player_new(self):
+        return FakeMediaPlayer()
+
+    def media_new(self, mrl, *options):
+        return FakeMedia(mrl)
+
+def install_fake_backends():
+    modules = {
+        'vlc': dict(Instance=FakeInstance, EventType=FakeEventType, State=FakeState),
+        'yt_dlp': dict(YoutubeDL=FakeYoutubeDL),
+        'googleapiclient': {},
+        'googleapiclient.discovery': dict(build=lambda *args, **kwargs: FakeYoutube()),
+        'googleapiclient.errors': dict(HttpError=FakeHttpError),
+        'httplib2': dict(Http=FakeHttp),
+    }
+    for name, attributes in modules.items():
+        module = types.ModuleType(name)
+        module.__dict__.update(attributes)
+        sys.modules[name] = module
+
+# Conditions a session can wait for with '@wait <condition> [timeout]'
+def wait_conditions(main):
+    state = main.state
+    return {
+        'results': lambda: state.search_results is not None,
+        'playing': lambda: state.playing and state.request_started is None and not state.loading,
+        # media_started stays set from opening a track until it plays, so a track about to start is not taken for finished
+        'finished': lambda: not state.loading and not state.playing and state.media_started is None and not state.playlist.has_next(),
+    }
+
+def run_command(main, command):
+    handled = threading.Event()
+    main.post_event(main.handle_command, command)
+    main.post_event(handled.set)
+    handled.wait()
+
+def run_session(main, session_file):
+    conditions = wait_conditions(main)
+    with open(session_file) as file:
+        lines = [line.strip() for line in file]
+    for line in lines:
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('@sleep'):
+            time.sleep(float(line.split()[1]))
+        elif line.startswith('@wait'):
+            parts = line.split()
+            condition = conditions[parts[1]]
+            deadline = time.time() + (float(parts[2]) if len(parts) > 2 else 15)
+            while not condition():
+                if time.time() > deadline:
+                    raise TimeoutError(f"Timed out waiting for '{parts[1]}' in {os.path.basename(session_file)}")
+                time.sleep(0.01)
+        else:
+            run_command(main, line)
+    main.flush_db_writes()
+
+# Runs one session in this process, inside a scratch directory, and prints its raw timings as JSON
+def run_worker(session_file, seed, verbose):
+    global fixtures
+    with open(FIXTURES_FILE) as file:
+        fixtures = json.load(file)
+    latency_rng.seed(seed)
+    install_fake_backends()
+    sys.path.insert(0, REPO_DIR)
+    output = sys.stdout
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        import yaml
+        with open('config.yml', 'w') as file:
+            yaml.dump(BENCHMARK_CONFIG, file)
+        # Left redirected for good: background threads may still print after the session ends, and the
+        # results pipe must carry nothing but the JSON
+        sys.stdout = open(os.devnull, 'w') if not verbose else sys.stderr
+        import main
+        threading.Thread(target=main.run_event_loop, name='event-loop', daemon=True).start()
+        run_session(main, session_file)
+        with main.stage_timings_lock:
+            timings = {stage: list(values) for stage, values in main.stage_timings.items()}
+    json.dump(timings, output)
+    output.flush()
+
+def summarize(timings):
+    summary = {}
+    for stage, values in timings.items():
+        values = sorted(values)
+        if values:
+            summary[stage] = {
+                'count': len(values),
+                'p50': values[min(len(values) - 1, int(len(values) * 0.5))],
+                'p95': values[min(len(values) - 1, int(len(values) * 0.95))],
+                'max': values[-1],
+            }
+    return summary
+
+def print_summary(name, summary):
+    print(f"\n{name}")
+    print(f"  {'Stage':<24}{'Count':>6}{'p50':>10}{'p95':>10}{'Max':>10}")
+    for stage, values in sorted(summary.items()):
+        print(f"  {stage:<24}{values['count']:>6}{values['p50']:>7.1f} ms{values['p95']:>7.1f} ms{values['max']:>7.1f} ms")
+
+# Report headline stages that got slower than the baseline by more than the tolerance
+def compare_to_baseline(results, baseline, tolerance):
+    regressions = []
+    for name, summary in results.items():
+        for stage in HEADLINE_STAGES:
+            before = baseline.get(name, {}).get(stage)
+            after = summary.get(stage)
+            if not before or not after:
+                continue
+            for key in ('p50', 'p95'):
+                if after[key] > before[key] * (1 + tolerance):
+                    regressions.append(f"{name}: {stage} {key} {before[key]:.1f} ms -> {after[key]:.1f} ms")
+    return regressions
+
+def run_benchmarks():
+    parser = argparse.ArgumentParser(description='Replay scripted player sessions against fake YouTube, yt-dlp and VLC backends.')
+    parser.add_argument('sessions', nargs='*', help='session files to run (default: every file in benchmarks/sessions)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per session; timings from all runs are pooled')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the simulated latency jitter')
+    parser.add_argument('--json', help='write the per-session summary to this file')
+    parser.add_argument('--baseline', help='summary written by an earlier --json run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown before a headline stage counts as a regression')
+    parser.add_argument('--verbose', action='store_true', help="show the player's output on stderr")
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.worker, args.seed, args.verbose)
+        return 0
+
+    session_files = args.sessions or sorted(os.path.join(SESSIONS_DIR, name) for name in os.listdir(SESSIONS_DIR) if name.endswith('.txt'))
+    results = {}
+    for session_file in session_files:
+        name = os.path.splitext(os.path.basename(session_file))[0]
+        pooled = {}
+        for run in range(args.repeat):
+            # A fresh interpreter per run so every run starts with cold caches and an empty database
+            command = [sys.executable, os.path.abspath(__file__), '--worker', os.path.abspath(session_file), '--seed', str(args.seed + run)]
+            if args.verbose:
+                command.append('--verbose')
+            completed = subprocess.run(command, stdout=subprocess.PIPE, text=True)
+            if completed.returncode != 0:
+                print(f"Session {name} failed (run {run + 1})")
+                return 1
+            for stage, values in json.loads(completed.stdout).items():
+                pooled.setdefault(stage, []).extend(values)
+        results[name] = summarize(pooled)
+        print_summary(name, results[name])
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare_to_baseline(results, json.load(file), args.tolerance)
+        if regressions:
+            print("\nRegressions:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("\nNo regressions against the baseline.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(run_benchmarks())
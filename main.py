@@ -1,634 +1,3605 @@
-import os
-import yaml
-import sqlite3
-from googleapiclient.discovery import build
-from yt_dlp import YoutubeDL
-import vlc
-import unidecode
-import time
-
-# Constants
-CONFIG_FILE = "config.yml"
-DATABASE_FILE = "music_player.db"
-YOUTUBE_API_KEY = 'YOUR_YOUTUBE_API_KEY'  # Replace with your YouTube API key
-
-# Global variables to keep track of VLC player and playlist state
-player = None
-media = None
-current_playlist = []
-current_index = 0
-paused_time = 0
-queue = []
-playlist_mode = False
-
-# Logo
-def display_logo():
-    logo = r'''
- ▄▄▄▄▄▄▄    ▄▄▄        ▄▄▄    ▄▄▄▄▄▄▄    ▄▄▄        ▄▄▄▄▄▄    ▄▄   ▄▄    ▄▄▄▄▄▄▄    ▄▄▄▄▄▄   
-█       █  █   █      █   █  █       █  █   █      █      █  █  █ █  █  █       █  █   ▄  █  
-█       █  █   █      █   █  █    ▄  █  █   █      █  ▄   █  █  █▄█  █  █    ▄▄▄█  █  █ █ █  
-█     ▄▄█  █   █      █   █  █   █▄█ █  █   █      █ █▄█  █  █       █  █   █▄▄▄   █   █▄▄█▄ 
-█    █     █   █▄▄▄   █   █  █    ▄▄▄█  █   █▄▄▄   █      █  █▄     ▄█  █    ▄▄▄█  █    ▄▄  █
-█    █▄▄   █       █  █   █  █   █      █       █  █  ▄   █    █   █    █   █▄▄▄   █   █  █ █
-█▄▄▄▄▄▄▄█  █▄▄▄▄▄▄▄█  █▄▄▄█  █▄▄▄█      █▄▄▄▄▄▄▄█  █▄█ █▄▄█    █▄▄▄█    █▄▄▄▄▄▄▄█  █▄▄▄█  █▄█
-    '''
-    print(logo)
-    print("[ If you don't know how to use **cliplayer**, please type **help**. ]")
-
-# Help command
-def display_help():
-    help_text = '''
-Available Commands:
-- play <song name or YouTube URL>: Search and play a song from YouTube.
-- pp <playlist URL>: Play all songs from a YouTube playlist.
-- fav: Add the currently playing song to favorites.
-- favlist: List all favorite songs.
-- favr <song ID> or fr <song ID>: Remove a song from favorites by its ID.
-- favplay <song ID>: Play a favorite song by its ID or add it to the queue.
-- pf: Play all favorite songs.
-- next [<number>]: Play the next song or skip to a specific song in the playlist.
-- prev or previous: Play the previous song in the playlist.
-- vol <volume>: Set the volume (0-100).
-- seek <seconds>: Seek to a specific time in the current song.
-- repeat or replay: Replay the current song.
-- now: Display the currently playing song.
-- pause: Pause the current song.
-- resume: Resume the paused song.
-- stop: Stop the current song.
-- close: Close the player and clear the playlist.
-- playlist restart: Restart the current playlist.
-- last: Play the last played song.
-- session: Display session details.
-- config: Display the current configuration.
-    '''
-    print(help_text)
-
-# Load or create config
-def load_config():
-    if not os.path.exists(CONFIG_FILE):
-        default_config = {
-            'database': 'sqlite',
-            'language': 'en',
-            'volume': 50,
-            'equalizer': {},
-        }
-        with open(CONFIG_FILE, 'w') as file:
-            yaml.dump(default_config, file)
-        return default_config
-    else:
-        with open(CONFIG_FILE, 'r') as file:
-            return yaml.safe_load(file)
-
-config = load_config()
-
-# Database initialization
-def init_db():
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS songs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            title TEXT,
-            url TEXT,
-            is_favorite BOOLEAN DEFAULT 0
-        )
-    ''')
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS last_played (
-            id INTEGER PRIMARY KEY,
-            title TEXT,
-            url TEXT
-        )
-    ''')
-    conn.commit()
-    conn.close()
-
-init_db()
-
-# Transliterate function
-def transliterate(text):
-    return unidecode.unidecode(text)
-
-# Add favorite song
-def add_favorite(title, url):
-    title = transliterate(title)
-    try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        cursor.execute('SELECT id FROM songs WHERE title = ? AND url = ? AND is_favorite = 1', (title, url))
-        result = cursor.fetchone()
-        if result:
-            print("Error: This song is already in your favorites.")
-        else:
-            cursor.execute('INSERT OR IGNORE INTO songs (title, url, is_favorite) VALUES (?, ?, 1)', (title, url))
-            conn.commit()
-            renumber_favorites()
-            print("Song added to favorites.")
-        conn.close()
-    except sqlite3.IntegrityError as e:
-        print(f"Error adding to favorites: {e}")
-
-def renumber_favorites():
-    try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        cursor.execute('SELECT rowid, * FROM songs WHERE is_favorite = 1 ORDER BY rowid')
-        favorites = cursor.fetchall()
-        for index, song in enumerate(favorites):
-            cursor.execute('UPDATE songs SET id = ? WHERE rowid = ?', (index + 1, song[0]))
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        print(f"Error renumbering favorites: {e}")
-
-def list_favorites():
-    try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        cursor.execute('SELECT id, title, url FROM songs WHERE is_favorite = 1 ORDER BY id')
-        favorites = cursor.fetchall()
-        conn.close()
-        if favorites:
-            print("Favorite Songs:")
-            for song in favorites:
-                print(f"{song[0]}. {song[1]} ({song[2]})")
-        else:
-            print("No favorite songs found.")
-    except Exception as e:
-        print(f"Error listing favorites: {e}")
-
-def remove_from_favorites(song_id):
-    try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM songs WHERE id = ? AND is_favorite = 1', (song_id,))
-        conn.commit()
-        renumber_favorites()
-        conn.close()
-        print("Song removed from favorites.")
-    except Exception as e:
-        print(f"Error removing from favorites: {e}")
-
-def play_favorites():
-    global current_playlist, current_index, playlist_mode
-    try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        cursor.execute('SELECT title, url FROM songs WHERE is_favorite = 1 ORDER BY id')
-        current_playlist = [{'title': row[0], 'url': row[1]} for row in cursor.fetchall()]
-        conn.close()
-        current_index = 0
-        playlist_mode = False
-        play_next_song()
-    except Exception as e:
-        print(f"Error playing favorites: {e}")
-
-def play_favorite_by_id(song_id):
-    global queue
-    try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        cursor.execute('SELECT title, url FROM songs WHERE id = ? AND is_favorite = 1', (song_id,))
-        song = cursor.fetchone()
-        conn.close()
-        if song:
-            song_data = {'title': song[0], 'url': song[1]}
-            if player and player.is_playing():
-                queue.append(song_data)
-                print(f"Favorite song added to the queue: {song_data['title']} ({song_data['url']})")
-            else:
-                current_playlist.append(song_data)
-                play_next_song(len(current_playlist))
-        else:
-            print(f"No favorite song found with ID: {song_id}")
-    except Exception as e:
-        print(f"Error playing favorite by ID: {e}")
-
-# Update last played song
-def update_last_played(title, url):
-    try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM last_played')
-        cursor.execute('INSERT INTO last_played (id, title, url) VALUES (1, ?, ?)', (title, url))
-        conn.commit()
-        conn.close()
-    except Exception as e:
-        print(f"Error updating last played song: {e}")
-
-# Play last played song
-def play_last_played():
-    try:
-        conn = sqlite3.connect(DATABASE_FILE)
-        cursor = conn.cursor()
-        cursor.execute('SELECT title, url FROM last_played WHERE id = 1')
-        last_song = cursor.fetchone()
-        conn.close()
-        if last_song:
-            play_song_from_url(last_song[1])
-        else:
-            print("No last played song found.")
-    except Exception as e:
-        print(f"Error playing last played song: {e}")
-
-# YouTube API setup
-youtube = build('youtube', 'v3', developerKey=YOUTUBE_API_KEY)
-
-def search_youtube(query):
-    try:
-        request = youtube.search().list(
-            part='snippet',
-            q=query,
-            type='video',
-            maxResults=5
-        )
-        response = request.execute()
-        return [{'title': item['snippet']['title'], 'url': f"https://www.youtube.com/watch?v={item['id']['videoId']}"} for item in response['items']]
-    except Exception as e:
-        print(f"Error searching YouTube: {e}")
-        return []
-
-def extract_streaming_url(youtube_url):
-    try:
-        ydl_opts = {
-            'format': 'bestaudio/best',
-            'quiet': True,
-            'no_warnings': True,
-            'force_generic_extractor': True,
-        }
-        with YoutubeDL(ydl_opts) as ydl:
-            info_dict = ydl.extract_info(youtube_url, download=False)
-            return info_dict['url']
-    except Exception as e:
-        print(f"Error extracting streaming URL: {e}")
-        return None
-
-def on_media_finished(event):
-    global current_index, current_playlist, playlist_mode
-    if current_index < len(current_playlist):
-        play_next_song()
-    else:
-        if playlist_mode:
-            print("Playlist completely played. Type 'playlist restart' to restart the playlist or 'close' to exit.")
-
-def stream_audio_with_vlc(url):
-    global player, media
-    try:
-        instance = vlc.Instance()
-        player = instance.media_player_new()
-        media = instance.media_new(url)
-        player.set_media(media)
-        player.play()
-        events = player.event_manager()
-        events.event_attach(vlc.EventType.MediaPlayerEndReached, on_media_finished)
-        update_display()
-    except Exception as e:
-        print(f"Error playing audio with VLC: {e}")
-
-def play_next_song(index=None):
-    global current_index, current_playlist, queue, playlist_mode
-    if player:
-        player.stop()
-    if index is not None:
-        current_index = index - 1
-    if current_playlist and current_index < len(current_playlist):
-        song = current_playlist[current_index]
-        streaming_url = extract_streaming_url(song['url'])
-        if streaming_url:
-            stream_audio_with_vlc(streaming_url)
-            update_last_played(song['title'], song['url'])
-            display_now_playing(song['title'], song['url'])
-            current_index += 1
-        else:
-            print(f"Error: Could not stream {song['title']}")
-            current_index += 1
-            play_next_song()
-    elif queue:
-        song = queue.pop(0)
-        streaming_url = extract_streaming_url(song['url'])
-        if streaming_url:
-            stream_audio_with_vlc(streaming_url)
-            current_playlist.append(song)
-            current_index = len(current_playlist)
-            update_last_played(song['title'], song['url'])
-            display_now_playing(song['title'], song['url'])
-        else:
-            print(f"Error: Could not stream {song['title']}")
-    else:
-        if playlist_mode:
-            print("Playlist completely played. Type 'playlist restart' to restart the playlist or 'close' to exit.")
-        else:
-            print("No next song available in the queue.")
-
-def play_previous_song():
-    global current_index, current_playlist, queue
-    if player:
-        player.stop()
-    if current_playlist and current_index > 1:
-        current_index -= 2
-        play_next_song()
-    elif queue:
-        print("No previous song available in the queue.")
-    else:
-        print("No previous song available.")
-
-def extract_playlist_videos(playlist_url):
-    try:
-        playlist_id = playlist_url.split("list=")[-1]
-        request = youtube.playlistItems().list(
-            part="snippet",
-            playlistId=playlist_id,
-            maxResults=50
-        )
-        response = request.execute()
-        videos = [{'title': item['snippet']['title'], 'url': f"https://www.youtube.com/watch?v={item['snippet']['resourceId']['videoId']}"} for item in response['items']]
-        playlist_info_request = youtube.playlists().list(
-            part="snippet",
-            id=playlist_id
-        )
-        playlist_info_response = playlist_info_request.execute()
-        playlist_name = playlist_info_response['items'][0]['snippet']['title']
-        # Filter out unavailable videos
-        videos = [video for video in videos if 'Deleted video' not in video['title'] and 'Private video' not in video['title']]
-        return playlist_name, videos
-    except Exception as e:
-        print(f"Error extracting playlist videos: {e}")
-        return None, []
-
-def play_song_from_url(youtube_url):
-    global current_playlist, current_index
-    streaming_url = extract_streaming_url(youtube_url)
-    if streaming_url:
-        stream_audio_with_vlc(streaming_url)
-        song = {'title': youtube_url, 'url': youtube_url}  # Assuming title as URL for direct links
-        current_playlist.append(song)
-        update_last_played(song['title'], song['url'])
-        display_now_playing(song['title'], song['url'])
-        return True
-    else:
-        print(f"Error: Could not stream {youtube_url}")
-        return False
-
-# Update display function
-def update_display():
-    if player and player.is_playing():
-        song = current_playlist[current_index - 1]
-        current_time = player.get_time() // 1000
-        length = player.get_length() // 1000
-        volume = player.audio_get_volume()
-        song_title = song['title']
-        duration = f"{length // 60}:{length % 60:02d}"
-        elapsed = f"{current_time // 60}:{current_time % 60:02d}"
-
-        volume_bar = '▁▂▃▄▅▆▇'
-        volume_level = volume_bar[:volume * len(volume_bar) // 100]
-
-        display_text = f'''
-({song_title})
-{elapsed} ━{'━' * ((current_time * 10) // length)}❍{'━' * (10 - (current_time * 10) // length)} -{duration}
-              ↻     ⊲  Ⅱ  ⊳     ↺
-VOLUME: {volume_level}
-        '''
-
-        print(display_text)
-
-def display_now_playing(title, url):
-    ascii_art = f'''
-  ______ _ _       _                                       
- |  ____(_) |     | |                                      
- | |__   _| | ___ | |__   ___ _ __                          
- |  __| | | |/ _ \\| '_ \\ / _ \\ '__|                         
- | |    | | | (_) | |_) |  __/ |                            
- |_|    |_|_|\\___/|_.__/ \\___|_|                            
-                                                           
- _   _  ____  _     _____ ____  _        _     _____ ____  
-| | | |/ __ \\| |   |_   _|  _ \\| |      | |   |_   _/ __ \\ 
-| | | | |  | | |     | | | |_) | |      | |     | || |  | |
-| | | | |  | | |     | | |  _ <| |      | |     | || |  | |
-| |_| | |__| | |_____| |_| |_) | |____  | |_____| || |__| |
- \\___/ \\____/|______|_____|____/|______| |______|____\\____/ 
-                                                           
-Now playing: {title} ({url})
-'''
-    print(ascii_art)
-
-# Command handlers
-def handle_command(command):
-    global player, media, current_playlist, current_index, paused_time, queue, playlist_mode
-    parts = command.split()
-    cmd = parts[0]
-    args = parts[1:]
-
-    def is_playing():
-        if not player or not player.is_playing():
-            print(f"Command '{cmd}' cannot be used when no song is playing.")
-            return False
-        return True
-
-    if cmd == 'play':
-        if playlist_mode:
-            print("Cannot add songs to the playlist. Please type 'close' to exit the playlist mode.")
-        else:
-            query = " ".join(args)
-            if "youtube.com/watch?v=" in query:
-                play_song_from_url(query)
-            else:
-                results = search_youtube(query)
-                for i, result in enumerate(results):
-                    print(f"{i+1}. {result['title']} ({result['url']})")
-                while True:
-                    selection = input("Select a song (1-5) or type 'close' to exit: ")
-                    if selection.lower() == 'close':
-                        print("Song selection closed.")
-                        return
-                    try:
-                        selection = int(selection) - 1
-                        if 0 <= selection < len(results):
-                            break
-                        else:
-                            print("Invalid selection. Please enter a number between 1 and 5.")
-                    except ValueError:
-                        print("Invalid input. Please enter a number between 1 and 5 or type 'close' to exit.")
-                
-                new_song = results[selection]
-                if player and player.is_playing():
-                    queue.append(new_song)
-                    print("New song added to the queue.")
-                else:
-                    current_playlist.append(new_song)
-                    current_index = len(current_playlist)
-                    streaming_url = extract_streaming_url(new_song['url'])
-                    if streaming_url:
-                        stream_audio_with_vlc(streaming_url)
-                        update_last_played(new_song['title'], new_song['url'])
-                        display_now_playing(new_song['title'], new_song['url'])
-                    else:
-                        print(f"Error: Could not stream {new_song['title']}")
-    elif cmd == 'pp':
-        playlist_url = args[0]
-        playlist_name, current_playlist = extract_playlist_videos(playlist_url)
-        if current_playlist:
-            current_index = 0
-            playlist_mode = True
-            print(f"Playlist: {playlist_name}")
-            for i, song in enumerate(current_playlist):
-                print(f"{i+1}. {song['title']} ({song['url']})")
-            play_next_song()
-        else:
-            print("Error: Could not load playlist.")
-    elif cmd == 'fav':
-        if current_index > 0 and current_index <= len(current_playlist):
-            song = current_playlist[current_index - 1]
-            add_favorite(song['title'], song['url'])
-        else:
-            print("No song is currently playing to add to favorites.")
-    elif cmd == 'favlist':
-        list_favorites()
-    elif cmd == 'favr' or cmd == 'fr':
-        if len(args) > 0:
-            try:
-                song_id = int(args[0])
-                remove_from_favorites(song_id)
-            except ValueError:
-                print("Invalid song ID.")
-        else:
-            print("Please provide a song ID to remove from favorites.")
-    elif cmd == 'favplay':
-        if len(args) > 0:
-            try:
-                song_id = int(args[0])
-                play_favorite_by_id(song_id)
-            except ValueError:
-                print("Invalid song ID.")
-        else:
-            print("Please provide a song ID to play from favorites.")
-    elif cmd == 'pf':
-        play_favorites()
-    elif cmd == 'next':
-        if current_playlist or queue:
-            if len(args) > 0:
-                song_index = int(args[0])
-                if 1 <= song_index <= len(current_playlist):
-                    play_next_song(song_index)
-                else:
-                    print("Invalid song number.")
-            else:
-                play_next_song()
-        else:
-            print("No next song available.")
-    elif cmd == 'previous' or cmd == 'prev':
-        if current_playlist or queue:
-            play_previous_song()
-        else:
-            print("No previous song available.")
-    elif cmd == 'vol' or cmd == 'volume':
-        volume = int(args[0])
-        if 0 <= volume <= 100:
-            if player:
-                old_volume = player.audio_get_volume()
-                player.audio_set_volume(volume)
-                print(f"Volume set from {old_volume} to {volume}.")
-            else:
-                print("No song is currently playing to set volume.")
-        else:
-            print("Volume must be between 0 and 100.")
-    elif cmd == 'seek':
-        if len(args) > 0:
-            try:
-                seek_value = int(args[0])
-                if is_playing():
-                    length = player.get_length() // 1000  # Get length in seconds
-                    if 0 <= seek_value <= length:
-                        player.set_time(seek_value * 1000)  # Seek in milliseconds
-                        print(f"Seeked to {seek_value} seconds.")
-                        update_display()
-                    else:
-                        print(f"Invalid seek time. Please enter a value between 0 and {length} seconds.")
-            except ValueError:
-                print("Invalid input. Please enter the number of seconds to seek.")
-        else:
-            print("Please provide the number of seconds to seek. Usage: seek <seconds>")
-    elif cmd == 'repeat' or cmd == 'replay':
-        if player:
-            player.set_time(0)
-            player.play()
-            print("Song replayed.")
-            update_display()
-        else:
-            print("No song is currently playing to repeat.")
-    elif cmd == 'now':
-        if current_index > 0 and current_index <= len(current_playlist):
-            song = current_playlist[current_index - 1]
-            display_now_playing(song['title'], song['url'])
-            update_display()
-        else:
-            print("No song is currently playing.")
-    elif cmd == 'pause':
-        if player and player.is_playing():
-            paused_time = player.get_time()
-            player.pause()
-            print("Playback paused.")
-            update_display()
-        else:
-            print("No song is currently playing to pause.")
-    elif cmd == 'resume':
-        if player:
-            player.set_time(paused_time)
-            player.play()
-            print("Playback resumed.")
-            update_display()
-        else:
-            print("No song is currently paused to resume.")
-    elif cmd == 'stop':
-        if player and player.is_playing():
-            player.stop()
-            print("Playback stopped.")
-            update_display()
-        else:
-            print("No song is currently playing to stop.")
-    elif cmd == 'close':
-        if player:
-            if player.is_playing():
-                player.stop()
-            player.release()
-            player = None
-            media = None
-            current_playlist = []
-            current_index = 0
-            paused_time = 0
-            queue = []
-            playlist_mode = False
-            print("Player closed.")
-            update_display()
-        else:
-            print("No song is currently playing to close.")
-    elif cmd == 'playlist' and args[0] == 'restart':
-        if current_playlist:
-            current_index = 0
-            play_next_song()
-        else:
-            print("Cannot restart. No playlist loaded.")
-    elif cmd == 'last':
-        play_last_played()
-    elif cmd == 'session':
-        if player and player.is_playing():
-            song = current_playlist[current_index - 1]
-            current_time = player.get_time() // 1000
-            length = player.get_length() // 1000
-            print(f"Currently playing: {song['title']} ({song['url']})")
-            print(f"Time: {current_time} seconds / {length} seconds")
-        else:
-            print("No song is currently playing.")
-    elif cmd == 'config':
-        print(yaml.dump(config))
-    elif cmd == 'help':
-        display_help()
-
-if __name__ == "__main__":
-    display_logo()
-    while True:
-        try:
-            command = input("> ")
-            handle_command(command)
-        except Exception as e:
-            print(f"An error occurred: {e}")
+import time
+startup_started = time.perf_counter()
+import os
+import sys
+import json
+import re
+import zlib
+import array
+import random
+import math
+import datetime
+import yaml
+import sqlite3
+import unidecode
+import urllib.parse
+import threading
+import functools
+import atexit
+import contextlib
+import shutil
+import tempfile
+import unicodedata
+import weakref
+import itertools
+import socket
+import socketserver
+from queue import Queue, Empty
+from collections import deque, Counter
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# googleapiclient, yt_dlp and vlc are slow to import; they are loaded on first use or by warm_up() after the prompt shows
+vlc = None
+
+# Startup profiling for --profile-startup: (label, milliseconds)
+startup_timings = []
+
+def record_startup(label, started):
+    startup_timings.append((label, (time.perf_counter() - started) * 1000))
+    return time.perf_counter()
+
+record_startup('imports', startup_started)
+
+# Constants
+CONFIG_FILE = "config.yml"
+DATABASE_FILE = "music_player.db"
+YOUTUBE_API_KEY = 'YOUR_YOUTUBE_API_KEY'  # Replace with your YouTube API key
+STREAM_EXPIRY_MARGIN = 300  # Treat cached stream URLs as expired this many seconds early
+STREAM_DEFAULT_TTL = 3600  # Used when a stream URL carries no expire= parameter
+HISTORY_PERIODS = {'day': 86400, 'week': 7 * 86400, 'month': 30 * 86400, 'year': 365 * 86400, 'all': None}
+SCHEMA_VERSION = 4  # Stored in PRAGMA user_version; bump together with a step in migrate_db
+STATS_WINDOW = 200  # Recent timings kept per pipeline stage for the stats command
+PLAYLIST_HISTORY_SIZE = 500  # Played tracks kept behind the cursor for 'prev' once songs are appended
+FAVORITES_BATCH_SIZE = 1000  # Rows per executemany when importing favorites
+AUDIO_BITRATE_STEPS = (48, 64, 96, 128, 160, 256)  # kbps levels adaptive stream selection moves between
+BITRATE_PROBE_TRACKS = 3  # Tracks in a row without a stall before quality steps back up when no throughput is measured
+THROUGHPUT_MIN_BYTES = 256 * 1024  # Smaller transfers are mostly connection setup and say little about the link
+AUDIO_CODEC_PREFERENCE = ('opus', 'mp4a', 'vorbis')  # Audio-only codecs VLC decodes cheaply, best first
+STALL_TIMEOUT = 15  # Seconds without playback progress before a playing stream is treated as dead
+STREAM_CUTOFF_MARGIN_MS = 5000  # A stream ending this far before its length was cut off, not finished
+STREAM_RECOVERY_ATTEMPTS = 2  # Re-resolves per track before giving up on it
+METADATA_BATCH_SIZE = 50  # Video IDs per videos().list call, the API maximum
+VIDEO_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]{11}')
+RESOLVER_BACKENDS = ('yt-dlp', 'yt-dlp alt', 'pytube')  # Stream resolution backends, tried in this order
+ALT_PLAYER_CLIENTS = ['ios', 'android']  # YouTube player clients the 'yt-dlp alt' backend asks for
+CIRCUIT_FAILURE_LIMIT = 3  # Failures in a row before a resolver backend is skipped
+CIRCUIT_COOLDOWN = 60  # Seconds a tripped backend is skipped before one trial call is let through
+FAILED_START_LIMIT = 3  # Tracks in a row that fail to resolve before automatic skipping stops
+VIDEO_ERROR_PATTERN = re.compile(r'unavailable|private video|has been removed|members-only|age.restricted|confirm your age', re.I)
+LOUDNESS_SAMPLE_RATE = 48000  # Analysis rate; the BS.1770 K-weighting coefficients below are specified for 48 kHz
+LOUDNESS_PEAK_CEILING = -1.0  # dBFS a normalization boost may bring a track's peak up to, since VLC's preamp clips
+LOUDNESS_MAX_GAIN = 12.0  # dB either way normalization may move a track
+RADIO_FEATURES = 1 << 18  # Hashed term buckets in the radio similarity index
+RADIO_LOOKAHEAD = 2  # Radio picks kept queued ahead, so prefetch has them resolved before they are needed
+RADIO_CHOICES = 5  # Best matches a radio pick is drawn from, so the same seed does not always lead the same way
+RADIO_COMMON_TERMS = 0.2  # Terms in more than this share of a large library are skipped in queries; they barely move the ranking
+QUOTA_COSTS = {'search': 100}  # Data API units per list call; every other endpoint we use costs 1
+QUOTA_TIMEZONE = 'America/Los_Angeles'  # Google resets the daily quota at midnight Pacific time
+SESSION_JOURNAL_INTERVAL = 1.0  # Seconds between checks for session changes to journal
+SESSION_JOURNAL_COMPACT_AFTER = 500  # Journal records appended before the file is rewritten as one snapshot
+
+DEFAULT_CONFIG = {
+    'database': 'sqlite',
+    'language': 'en',
+    'volume': 50,
+    'equalizer': {},
+    'stream_cache_size': 500,
+    'prefetch_count': 3,
+    'prefetch_workers': 2,
+    'playlist_cache_ttl': 21600,
+    'db_flush_interval': 2.0,
+    'search_cache_ttl': 86400,
+    'audio_cache_enabled': False,
+    'audio_cache_dir': 'audio_cache',
+    'audio_cache_max_bytes': 2 * 1024 ** 3,
+    'audio_cache_min_plays': 3,
+    'audio_cache_favorites': True,
+    'extractor_pool_size': 4,
+    'extractor_cache_dir': None,
+    'resolve_timeout': 30,
+    'resolve_deadline': 15,
+    'resolve_hedge_after': 3,
+    'batch_resolve_limit': 100,
+    'live_status': True,
+    'status_refresh_rate': 1.0,
+    'control_socket': 'cliplayer.sock',
+    'max_audio_bitrate': 160,
+    'adaptive_bitrate': True,
+    'throughput_probe_bytes': 512 * 1024,
+    'loudness_normalization': True,
+    'loudness_target': -14,
+    'api_daily_quota': 10000,
+    'api_quota_reserve': 1000,
+    'api_requests_per_second': 10,
+    'api_burst': 20,
+    'session_journal': 'session.journal',
+    'auto_restore': True,
+}
+
+# Pipeline instrumentation: recent durations in milliseconds per stage, shown by the stats command
+stage_timings = {}
+stage_timings_lock = threading.Lock()
+
+def record_span(stage, started):
+    elapsed = (time.perf_counter() - started) * 1000
+    with stage_timings_lock:
+        if stage not in stage_timings:
+            stage_timings[stage] = deque(maxlen=STATS_WINDOW)
+        stage_timings[stage].append(elapsed)
+
+# Usable as a with-block or as a function decorator
+@contextlib.contextmanager
+def timed(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(stage, started)
+
+def get_stage_stats():
+    with stage_timings_lock:
+        snapshot = {stage: sorted(timings) for stage, timings in stage_timings.items() if timings}
+    return {stage: {'count': len(timings), 'p50': percentile(timings, 0.5), 'p95': percentile(timings, 0.95), 'max': timings[-1]}
+            for stage, timings in snapshot.items()}
+
+def display_stats():
+    stats = get_stage_stats()
+    if not stats:
+        print("No timings recorded yet.")
+        return
+    print(f"{'Stage':<24}{'Count':>6}{'p50':>10}{'p95':>10}{'Max':>10}")
+    for stage, values in sorted(stats.items()):
+        print(f"{stage:<24}{values['count']:>6}{values['p50']:>7.1f} ms{values['p95']:>7.1f} ms{values['max']:>7.1f} ms")
+
+# Track records: one shared object per video ID, however many playlists, searches and replays refer to it
+class Track:
+    __slots__ = ('video_id', 'title', 'url', 'source', '__weakref__')
+
+    def __init__(self, video_id, title, url, source):
+        self.video_id = video_id
+        self.title = title
+        self.url = url
+        self.source = source  # How the track was last queued: search, playlist, favorites, url, history or radio
+
+tracks_by_id = weakref.WeakValueDictionary()
+tracks_lock = threading.Lock()
+
+def get_track(title, url, source=None):
+    video_id = get_video_id(url) or url
+    with tracks_lock:
+        track = tracks_by_id.get(video_id)
+        if track is None:
+            track = tracks_by_id[video_id] = Track(video_id, title, url, source)
+        else:
+            # Direct links use the URL as a stand-in title; never let it replace a real one
+            if title != url:
+                track.title = title
+            if source:
+                track.source = source
+    return track
+
+# Play order: the loaded tracks with a 1-based cursor, followed by the user's queue.
+# Positions keep counting from the original start after played tracks are trimmed off the front.
+class Playlist:
+    def __init__(self, tracks=None):
+        self.tracks = tracks if tracks is not None else []
+        self.trimmed = 0
+        self.position = 0  # Position of the current track; 0 before the first one starts
+        self.queue = deque()
+
+    def __len__(self):
+        return self.trimmed + len(self.tracks)
+
+    def load(self, tracks):
+        self.tracks = tracks
+        self.trimmed = 0
+        self.position = 0
+
+    def has_position(self, position):
+        return self.trimmed < position <= len(self)
+
+    def current(self):
+        if self.has_position(self.position):
+            return self.tracks[self.position - self.trimmed - 1]
+        return None
+
+    def jump(self, position):
+        self.position = position
+        return self.current()
+
+    def has_next(self):
+        return self.position < len(self) or bool(self.queue)
+
+    def advance(self):
+        if self.position < len(self):
+            self.position += 1
+        elif self.queue:
+            self.position = self.append(self.queue.popleft())
+        else:
+            return None
+        return self.current()
+
+    def upcoming(self, count):
+        start = self.position - self.trimmed
+        return self.tracks[start:start + count] + list(itertools.islice(self.queue, count))
+
+    # Returns the new track's position; replaying the current track does not add it again
+    def append(self, track):
+        if self.current() is track:
+            return self.position
+        self.tracks.append(track)
+        played = self.position - self.trimmed
+        if played > 2 * PLAYLIST_HISTORY_SIZE:
+            del self.tracks[:played - PLAYLIST_HISTORY_SIZE]
+            self.trimmed += played - PLAYLIST_HISTORY_SIZE
+        return len(self)
+
+# Player and playlist state, owned by the event loop thread
+class PlayerState:
+    def __init__(self):
+        self.player = None
+        self.media = None
+        self.playlist = Playlist()
+        self.paused_time = 0
+        self.playlist_mode = False
+        self.search_results = None  # Results waiting for a selection after 'play <query>'
+        self.play_request = 0  # Bumped on every track change so stale resolves are dropped
+        self.loading = False  # A requested track is still being resolved
+        self.history_entry = None  # Play history row for the current track, written when it ends
+        # Position model, kept current by VLC events so displays never poll the player
+        self.time_ms = 0
+        self.length_ms = 0
+        self.playing = False
+        self.volume = None
+        # perf_counter marks for the time-to-first-audio, buffering and transition gap spans
+        self.request_started = None
+        self.media_started = None
+        self.track_ended_at = None
+        # Adaptive bitrate: index into AUDIO_BITRATE_STEPS once adaptation kicked in, and the evidence it moves on
+        self.bitrate_step = None
+        self.throughput_kbps = None  # Smoothed rate of whole downloads
+        self.stalls = 0
+        self.clean_tracks = 0  # Tracks in a row that played without a stall
+        self.buffer_full = False
+        # Stream recovery: the URL VLC is playing, when playback last moved, and re-resolves spent on this track
+        self.stream_url = None
+        self.last_progress = None
+        self.recovery_attempts = 0
+        self.reopened_at_ms = None  # Where a recovered stream reopened; once it plays past this, its attempt is forgiven
+        self.stream_failed = False  # The stream broke while paused; resume reopens it
+        self.failed_starts = 0  # Tracks in a row that could not be resolved
+        self.equalizer_applied = False  # An equalizer is set on the player and must be removed for unfiltered tracks
+        self.radio = False  # Keep the queue topped up with similar tracks
+        self.restore_ms = None  # Where a restored session left off; 'resume' starts the current track there
+
+state = PlayerState()
+
+# VLC engine resources shared by every track
+vlc_instance = None
+preloaded_media = None  # (streaming_url, media) opened and paused on standby_player for the next song
+preload_requested = None  # Streaming URL last handed to preload_next, so repeated prefetch callbacks do not redo it
+standby_player = None  # Second player that buffers the next song while the current one plays; the two swap on each transition
+preload_lock = threading.Lock()
+
+# Commands, VLC events and finished background jobs are all handled in order on the event loop thread
+events = Queue()
+
+# Background stream URL prefetching, keyed by video ID
+prefetch_executor = None
+prefetch_futures = {}
+prefetch_lock = threading.Lock()
+
+# Background audio downloads for the on-disk cache, keyed by video ID
+audio_download_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='download')
+audio_downloads = set()
+audio_download_lock = threading.Lock()
+
+# Background YouTube Data API calls (playlist pages and metadata)
+api_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='api')
+
+# Network work started by commands (searches, playlist loads, stream resolution)
+job_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='job')
+
+# Logo
+def display_logo():
+    logo = r'''
+ ▄▄▄▄▄▄▄    ▄▄▄        ▄▄▄    ▄▄▄▄▄▄▄    ▄▄▄        ▄▄▄▄▄▄    ▄▄   ▄▄    ▄▄▄▄▄▄▄    ▄▄▄▄▄▄   
+█       █  █   █      █   █  █       █  █   █      █      █  █  █ █  █  █       █  █   ▄  █  
+█       █  █   █      █   █  █    ▄  █  █   █      █  ▄   █  █  █▄█  █  █    ▄▄▄█  █  █ █ █  
+█     ▄▄█  █   █      █   █  █   █▄█ █  █   █      █ █▄█  █  █       █  █   █▄▄▄   █   █▄▄█▄ 
+█    █     █   █▄▄▄   █   █  █    ▄▄▄█  █   █▄▄▄   █      █  █▄     ▄█  █    ▄▄▄█  █    ▄▄  █
+█    █▄▄   █       █  █   █  █   █      █       █  █  ▄   █    █   █    █   █▄▄▄   █   █  █ █
+█▄▄▄▄▄▄▄█  █▄▄▄▄▄▄▄█  █▄▄▄█  █▄▄▄█      █▄▄▄▄▄▄▄█  █▄█ █▄▄█    █▄▄▄█    █▄▄▄▄▄▄▄█  █▄▄▄█  █▄█
+    '''
+    print(logo)
+    print("[ If you don't know how to use **cliplayer**, please type **help**. ]")
+
+# Help command
+def display_help():
+    help_text = '''
+Available Commands:
+- play <song name or YouTube URL>: Search and play a song, checking your library before YouTube.
+- play! <song name>: Search YouTube directly, skipping your library and cached results.
+- pp <playlist URL>: Play all songs from a YouTube playlist.
+- fav: Add the currently playing song to favorites.
+- favlist: List all favorite songs.
+- favr <song ID> or fr <song ID>: Remove a song from favorites by its ID.
+- favplay <song ID>: Play a favorite song by its ID or add it to the queue.
+- pf: Play all favorite songs.
+- favimport <file or playlist URL>: Add favorites from a JSONL or M3U file or a YouTube playlist.
+- favexport <file>: Save your favorites as JSONL, or as M3U when the file ends in .m3u or .m3u8.
+- next [<number>]: Play the next song or skip to a specific song in the playlist.
+- prev or previous: Play the previous song in the playlist.
+- vol <volume>: Set the volume (0-100).
+- seek <seconds>: Seek to a specific time in the current song.
+- repeat or replay: Replay the current song.
+- now: Display the currently playing song.
+- pause: Pause the current song.
+- resume: Resume the paused song.
+- stop: Stop the current song.
+- close: Close the player and clear the playlist.
+- playlist restart: Restart the current playlist.
+- last [<n>]: Play the last played song, or the n-th most recent song in your history.
+- history [<n>]: Show the last n songs you listened to (default 10).
+- top [day|week|month|year|all]: Show your most played songs for a period (default week).
+- session: Display session details.
+- stats [reset]: Show p50/p95 timings for each playback pipeline stage, or clear them.
+- quota: Show today's YouTube API quota usage per endpoint.
+- radio [on|off]: When the queue runs out, keep playing songs similar to what you have been listening to.
+- restore: Bring back the playlist, queue and position from the last session and continue playing.
+- config: Display the current configuration.
+    '''
+    print(help_text)
+
+# Load or create config
+def load_config():
+    if not os.path.exists(CONFIG_FILE):
+        default_config = dict(DEFAULT_CONFIG)
+        with open(CONFIG_FILE, 'w') as file:
+            yaml.dump(default_config, file)
+        return default_config
+    else:
+        with open(CONFIG_FILE, 'r') as file:
+            # Fill in keys added after the config file was first written
+            return {**DEFAULT_CONFIG, **(yaml.safe_load(file) or {})}
+
+config_started = time.perf_counter()
+config = load_config()
+record_startup('config', config_started)
+
+# Transliterate function
+def transliterate(text):
+    return unidecode.unidecode(text)
+
+# Video ID of a watch or youtu.be URL, used as the stream cache key
+def get_video_id(youtube_url):
+    parsed = urllib.parse.urlparse(youtube_url)
+    if parsed.hostname and parsed.hostname.endswith('youtu.be'):
+        return parsed.path.lstrip('/') or None
+    return urllib.parse.parse_qs(parsed.query).get('v', [None])[0]
+
+# Database connections: one long-lived connection per thread, in WAL mode so readers never wait on the writer
+db_local = threading.local()
+
+db_initialized = False
+db_init_lock = threading.Lock()
+
+def get_db():
+    global db_initialized
+    conn = getattr(db_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DATABASE_FILE, timeout=10, cached_statements=256)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        db_local.conn = conn
+        # The schema is created or migrated by whichever thread touches the database first
+        with db_init_lock:
+            if not db_initialized:
+                init_db(conn)
+                db_initialized = True
+    return conn
+
+# Write-behind queue: frequent bookkeeping writes are batched into one transaction per flush interval
+db_writes = Queue()
+db_flush_requested = threading.Event()
+db_writer = None
+db_writer_lock = threading.Lock()
+
+def queue_db_write(sql, params=()):
+    global db_writer
+    with db_writer_lock:
+        if db_writer is None:
+            db_writer = threading.Thread(target=run_db_writer, name='db-writer', daemon=True)
+            db_writer.start()
+    db_writes.put((sql, params))
+
+def run_db_writer():
+    conn = get_db()
+    while True:
+        batch = [db_writes.get()]
+        db_flush_requested.wait(config['db_flush_interval'])
+        db_flush_requested.clear()
+        while not db_writes.empty():
+            batch.append(db_writes.get_nowait())
+        try:
+            with timed('db flush'), conn:
+                for item in batch:
+                    if not isinstance(item, threading.Event):
+                        conn.execute(*item)
+        except Exception as e:
+            print(f"Error writing to database: {e}")
+        for item in batch:
+            if isinstance(item, threading.Event):
+                item.set()
+
+# Block until every queued write has been committed
+def flush_db_writes(timeout=5):
+    if db_writer is None:
+        return
+    flushed = threading.Event()
+    db_writes.put(flushed)
+    db_flush_requested.set()
+    flushed.wait(timeout)
+
+atexit.register(flush_db_writes)
+
+# Local track catalog: every song seen in search results, favorites or history
+fts_enabled = False
+
+INDEX_TRACK_SQL = '''
+    INSERT INTO tracks (video_id, title, search_title, url, last_seen) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (video_id) DO UPDATE SET
+        title = CASE WHEN excluded.title = excluded.url THEN tracks.title ELSE excluded.title END,
+        search_title = CASE WHEN excluded.title = excluded.url THEN tracks.search_title ELSE excluded.search_title END,
+        last_seen = excluded.last_seen
+'''
+
+def track_row(title, url):
+    return (get_video_id(url) or url, title, transliterate(title), url, time.time())
+
+@timed('db index tracks')
+def index_tracks(songs):
+    try:
+        conn = get_db()
+        conn.executemany(INDEX_TRACK_SQL, [track_row(song['title'], song['url']) for song in songs])
+        conn.commit()
+        if radio_index is not None:
+            for song in songs:
+                radio_index.add(get_video_id(song['url']) or song['url'], song['title'], song['url'])
+    except Exception as e:
+        print(f"Error indexing tracks: {e}")
+
+# Schema migrations for databases created by older versions
+def migrate_db(conn):
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version < 1:
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(songs)')]
+        if 'position' not in columns:
+            # Favorite IDs used to be renumbered on every change; keep that order as positions and drop duplicate URLs
+            with conn:
+                conn.execute('''
+                    CREATE TABLE songs_v1 (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        title TEXT,
+                        url TEXT UNIQUE,
+                        is_favorite BOOLEAN DEFAULT 0,
+                        position INTEGER
+                    )
+                ''')
+                conn.execute('''
+                    INSERT OR IGNORE INTO songs_v1 (id, title, url, is_favorite, position)
+                    SELECT id, title, url, is_favorite, id FROM songs ORDER BY id
+                ''')
+                conn.execute('DROP TABLE songs')
+                conn.execute('ALTER TABLE songs_v1 RENAME TO songs')
+    if version < 2:
+        # Seed the local search index with what the user already has
+        rows = conn.execute('SELECT title, url FROM songs UNION SELECT title, url FROM last_played').fetchall()
+        with conn:
+            conn.executemany(INDEX_TRACK_SQL, [track_row(title, url) for title, url in rows])
+    if version < 3:
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(stream_cache)')]
+        if 'abr' not in columns:
+            conn.execute('ALTER TABLE stream_cache ADD COLUMN abr REAL')
+    if version < 4:
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(tracks)')]
+        for column, column_type in (('channel', 'TEXT'), ('duration', 'INTEGER'), ('metadata_at', 'REAL')):
+            if column not in columns:
+                conn.execute(f'ALTER TABLE tracks ADD COLUMN {column} {column_type}')
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(songs)')]
+        if 'video_id' not in columns:
+            # Favorites are matched to their metadata by video ID
+            conn.execute('ALTER TABLE songs ADD COLUMN video_id TEXT')
+            rows = conn.execute('SELECT id, url FROM songs').fetchall()
+            with conn:
+                conn.executemany('UPDATE songs SET video_id = ? WHERE id = ?', [(get_video_id(url) or url, song_id) for song_id, url in rows])
+    conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+# Database initialization
+def init_db(conn):
+    global fts_enabled
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS songs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            title TEXT,
+            url TEXT UNIQUE,
+            is_favorite BOOLEAN DEFAULT 0,
+            position INTEGER,
+            video_id TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS last_played (
+            id INTEGER PRIMARY KEY,
+            title TEXT,
+            url TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS stream_cache (
+            video_id TEXT PRIMARY KEY,
+            stream_url TEXT,
+            expires_at INTEGER,
+            last_used REAL,
+            abr REAL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_stream_cache_last_used ON stream_cache (last_used)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS playlist_cache (
+            playlist_id TEXT PRIMARY KEY,
+            name TEXT,
+            page_etag TEXT,
+            info_etag TEXT,
+            videos TEXT,
+            fetched_at REAL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tracks (
+            id INTEGER PRIMARY KEY,
+            video_id TEXT UNIQUE,
+            title TEXT,
+            search_title TEXT,
+            url TEXT,
+            last_seen REAL,
+            channel TEXT,
+            duration INTEGER,
+            metadata_at REAL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS audio_cache (
+            video_id TEXT PRIMARY KEY,
+            path TEXT,
+            size INTEGER,
+            last_used REAL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_audio_cache_last_used ON audio_cache (last_used)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS play_counts (
+            video_id TEXT PRIMARY KEY,
+            plays INTEGER DEFAULT 0
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_play_counts_plays ON play_counts (plays)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS play_history (
+            id INTEGER PRIMARY KEY,
+            video_id TEXT,
+            title TEXT,
+            url TEXT,
+            source TEXT,
+            started_at REAL,
+            duration REAL,
+            position REAL,
+            length REAL,
+            skipped BOOLEAN
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_play_history_video_id ON play_history (video_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_play_history_started_at ON play_history (started_at, video_id)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS track_loudness (
+            video_id TEXT PRIMARY KEY,
+            integrated REAL,
+            peak REAL,
+            analyzed_at REAL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS api_quota (
+            day TEXT,
+            endpoint TEXT,
+            units INTEGER,
+            calls INTEGER,
+            PRIMARY KEY (day, endpoint)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS search_cache (
+            query TEXT PRIMARY KEY,
+            results TEXT,
+            fetched_at REAL
+        )
+    ''')
+    try:
+        cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts USING fts5(search_title, content='tracks', content_rowid='id')")
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS tracks_fts_insert AFTER INSERT ON tracks BEGIN
+                INSERT INTO tracks_fts (rowid, search_title) VALUES (new.id, new.search_title);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS tracks_fts_delete AFTER DELETE ON tracks BEGIN
+                INSERT INTO tracks_fts (tracks_fts, rowid, search_title) VALUES ('delete', old.id, old.search_title);
+            END
+        ''')
+        cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS tracks_fts_update AFTER UPDATE OF search_title ON tracks BEGIN
+                INSERT INTO tracks_fts (tracks_fts, rowid, search_title) VALUES ('delete', old.id, old.search_title);
+                INSERT INTO tracks_fts (rowid, search_title) VALUES (new.id, new.search_title);
+            END
+        ''')
+        fts_enabled = True
+    except sqlite3.OperationalError as e:
+        print(f"Local search disabled, SQLite has no FTS5 support: {e}")
+    conn.commit()
+    migrate_db(conn)
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_songs_favorite_position ON songs (is_favorite, position)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_songs_video_id ON songs (video_id)')
+    conn.commit()
+
+# Add favorite song
+def add_favorite(title, url):
+    title = transliterate(title)
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        # New favorites go after the current last position; MAX is answered from the (is_favorite, position) index
+        cursor.execute('''
+            INSERT INTO songs (title, url, is_favorite, position, video_id)
+            VALUES (?, ?, 1, (SELECT COALESCE(MAX(position), 0) + 1 FROM songs WHERE is_favorite = 1), ?)
+            ON CONFLICT (url) DO UPDATE SET title = excluded.title, is_favorite = 1, position = excluded.position
+            WHERE is_favorite = 0
+        ''', (title, url, get_video_id(url) or url))
+        conn.commit()
+        if cursor.rowcount == 0:
+            print("Error: This song is already in your favorites.")
+        else:
+            index_tracks([{'title': title, 'url': url}])
+            schedule_audio_download(url)
+            request_metadata([get_video_id(url) or url])
+            print("Song added to favorites.")
+    except sqlite3.IntegrityError as e:
+        print(f"Error adding to favorites: {e}")
+
+def list_favorites():
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT songs.id, songs.title, songs.url, tracks.duration, tracks.channel FROM songs
+            LEFT JOIN tracks ON tracks.video_id = songs.video_id
+            WHERE songs.is_favorite = 1 ORDER BY songs.position
+        ''')
+        favorites = cursor.fetchall()
+        if favorites:
+            print("Favorite Songs:")
+            for song in favorites:
+                print(f"{song[0]}. {song[1]}{format_track_details(song[3], song[4])} ({song[2]})")
+        else:
+            print("No favorite songs found.")
+    except Exception as e:
+        print(f"Error listing favorites: {e}")
+
+def remove_from_favorites(song_id):
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM songs WHERE id = ? AND is_favorite = 1', (song_id,))
+        conn.commit()
+        if cursor.rowcount == 0:
+            print(f"No favorite song found with ID: {song_id}")
+        else:
+            print("Song removed from favorites.")
+    except Exception as e:
+        print(f"Error removing from favorites: {e}")
+
+# Bulk favorites import and export; JSONL holds one {"title", "url"} object per line, M3U uses #EXTINF titles
+FAVORITE_INSERT_SQL = '''
+    INSERT INTO songs (title, url, is_favorite, position, video_id) VALUES (?, ?, 1, ?, ?)
+    ON CONFLICT (url) DO UPDATE SET title = excluded.title, is_favorite = 1, position = excluded.position
+    WHERE is_favorite = 0
+'''
+
+def is_m3u_file(path):
+    return os.path.splitext(path)[1].lower() in ('.m3u', '.m3u8')
+
+def read_jsonl_favorites(file):
+    for line in file:
+        if line.strip():
+            entry = json.loads(line)
+            yield entry.get('title'), entry['url']
+
+def read_m3u_favorites(file):
+    title = None
+    for line in file:
+        line = line.strip()
+        if line.startswith('#EXTINF:'):
+            title = line.split(',', 1)[1] if ',' in line else None
+        elif line and not line.startswith('#'):
+            yield title, line
+            title = None
+
+def read_playlist_favorites(playlist_url):
+    playlist_id = get_playlist_id(playlist_url)
+    page_token = None
+    while True:
+        videos, page_token, _ = fetch_playlist_page(playlist_id, page_token)
+        for video in videos:
+            yield video.title, video.url
+        if not page_token:
+            break
+
+def insert_favorite_batch(conn, batch):
+    conn.executemany(FAVORITE_INSERT_SQL, batch)
+    conn.executemany(INDEX_TRACK_SQL, [track_row(title, url) for title, url, _, _ in batch])
+
+# Insert entries in batches inside one transaction, skipping videos that are already favorites
+def store_favorites(entries):
+    conn = get_db()
+    seen = {get_video_id(row[0]) or row[0] for row in conn.execute('SELECT url FROM songs WHERE is_favorite = 1')}
+    imported = skipped = 0
+    with conn:
+        position = conn.execute('SELECT COALESCE(MAX(position), 0) FROM songs WHERE is_favorite = 1').fetchone()[0]
+        batch = []
+        for title, url in entries:
+            video_id = get_video_id(url)
+            if (video_id or url) in seen:
+                skipped += 1
+                continue
+            seen.add(video_id or url)
+            if video_id:
+                url = f"https://www.youtube.com/watch?v={video_id}"
+            position += 1
+            batch.append((transliterate(title or url), url, position, video_id or url))
+            if len(batch) >= FAVORITES_BATCH_SIZE:
+                insert_favorite_batch(conn, batch)
+                imported += len(batch)
+                batch = []
+        if batch:
+            insert_favorite_batch(conn, batch)
+            imported += len(batch)
+    return imported, skipped
+
+def import_favorites(source):
+    try:
+        if source.startswith(('http://', 'https://')):
+            # Every page is fetched before the transaction opens, so the write lock is never held across network calls
+            result = store_favorites(list(read_playlist_favorites(source)))
+        else:
+            with open(source, encoding='utf-8') as file:
+                result = store_favorites(read_m3u_favorites(file) if is_m3u_file(source) else read_jsonl_favorites(file))
+        backfill_metadata()
+        return result
+    except Exception as e:
+        print(f"Error importing favorites: {e}")
+        return None
+
+def show_import_result(result):
+    if result:
+        imported, skipped = result
+        print(f"Imported {imported} favorite songs ({skipped} already in favorites).")
+
+def export_favorites(path):
+    try:
+        conn = get_db()
+        count = 0
+        with open(path, 'w', encoding='utf-8') as file:
+            m3u = is_m3u_file(path)
+            if m3u:
+                file.write('#EXTM3U\n')
+            # Rows are written as the cursor yields them, never collected into a list
+            for title, url in conn.execute('SELECT title, url FROM songs WHERE is_favorite = 1 ORDER BY position'):
+                if m3u:
+                    file.write(f"#EXTINF:-1,{title}\n{url}\n")
+                else:
+                    file.write(json.dumps({'title': title, 'url': url}, ensure_ascii=False) + '\n')
+                count += 1
+        return path, count
+    except Exception as e:
+        print(f"Error exporting favorites: {e}")
+        return None
+
+def show_export_result(result):
+    if result:
+        path, count = result
+        print(f"Exported {count} favorite songs to {path}.")
+
+def play_favorites():
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('SELECT title, url FROM songs WHERE is_favorite = 1 ORDER BY position')
+        state.playlist.load([get_track(row[0], row[1], 'favorites') for row in cursor.fetchall()])
+        state.playlist_mode = False
+        play_next_song()
+        resolve_playlist_ahead(state.playlist.tracks[1:])
+    except Exception as e:
+        print(f"Error playing favorites: {e}")
+
+def play_favorite_by_id(song_id):
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('SELECT title, url FROM songs WHERE id = ? AND is_favorite = 1', (song_id,))
+        song = cursor.fetchone()
+        if song:
+            track = get_track(song[0], song[1], 'favorites')
+            if is_busy():
+                state.playlist.queue.append(track)
+                print(f"Favorite song added to the queue: {track.title} ({track.url})")
+                schedule_prefetch()
+            else:
+                play_next_song(state.playlist.append(track))
+        else:
+            print(f"No favorite song found with ID: {song_id}")
+    except Exception as e:
+        print(f"Error playing favorite by ID: {e}")
+
+# Update last played song
+def update_last_played(title, url):
+    queue_db_write('INSERT OR REPLACE INTO last_played (id, title, url) VALUES (1, ?, ?)', (title, url))
+    queue_db_write(INDEX_TRACK_SQL, track_row(title, url))
+    queue_db_write('INSERT INTO play_counts (video_id, plays) VALUES (?, 1) ON CONFLICT (video_id) DO UPDATE SET plays = plays + 1',
+                   (get_video_id(url) or url,))
+
+# Play last played song
+def play_last_played():
+    try:
+        flush_db_writes()
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('SELECT title, url FROM last_played WHERE id = 1')
+        last_song = cursor.fetchone()
+        if last_song:
+            play_song_from_url(last_song[1], last_song[0], 'history')
+        else:
+            print("No last played song found.")
+    except Exception as e:
+        print(f"Error playing last played song: {e}")
+
+# Listening history
+def format_duration(seconds):
+    seconds = int(seconds or 0)
+    return f"{seconds // 60}:{seconds % 60:02d}"
+
+# Close the current track's history row; it is written through the write-behind queue
+def record_history_end(ended=False):
+    entry = state.history_entry
+    if entry is None:
+        return
+    state.history_entry = None
+    length = max(state.length_ms, 0) / 1000
+    position = length if ended else max(state.time_ms, 0) / 1000
+    paused = entry['paused_total'] + (time.time() - entry['paused_at'] if entry['paused_at'] else 0)
+    duration = max(0, time.time() - entry['started_at'] - paused)
+    song = entry['song']
+    queue_db_write('''
+        INSERT INTO play_history (video_id, title, url, source, started_at, duration, position, length, skipped)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (song.video_id, song.title, song.url, entry['source'],
+          entry['started_at'], duration, max(position, 0), length, not ended))
+
+def list_history(limit):
+    try:
+        flush_db_writes()
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('SELECT title, url, source, started_at, duration, position, skipped FROM play_history ORDER BY started_at DESC LIMIT ?', (limit,))
+        rows = cursor.fetchall()
+        if rows:
+            print("Listening History:")
+            for i, (title, url, source, started_at, duration, position, skipped) in enumerate(rows):
+                skip_note = f", skipped at {format_duration(position)}" if skipped else ""
+                print(f"{i+1}. {time.strftime('%Y-%m-%d %H:%M', time.localtime(started_at))} {title} ({format_duration(duration)} listened{skip_note}) [{source}]")
+        else:
+            print("No listening history found.")
+    except Exception as e:
+        print(f"Error listing history: {e}")
+
+def list_top_songs(period):
+    try:
+        flush_db_writes()
+        conn = get_db()
+        cursor = conn.cursor()
+        if HISTORY_PERIODS[period] is None:
+            # All-time counts are kept up to date in play_counts, so this never scans the history
+            cursor.execute('''
+                SELECT COALESCE(tracks.title, play_counts.video_id), play_counts.plays FROM play_counts
+                LEFT JOIN tracks ON tracks.video_id = play_counts.video_id
+                ORDER BY play_counts.plays DESC LIMIT 10
+            ''')
+        else:
+            # Count from the covering (started_at, video_id) index only, then look up titles for the top rows
+            cursor.execute('''
+                SELECT COALESCE(tracks.title, top.video_id), top.plays FROM (
+                    SELECT video_id, COUNT(*) AS plays FROM play_history INDEXED BY idx_play_history_started_at
+                    WHERE started_at >= ? GROUP BY video_id ORDER BY plays DESC LIMIT 10
+                ) AS top
+                LEFT JOIN tracks ON tracks.video_id = top.video_id
+                ORDER BY top.plays DESC
+            ''', (time.time() - HISTORY_PERIODS[period],))
+        rows = cursor.fetchall()
+        if rows:
+            print(f"Top Songs ({period}):")
+            for i, (title, plays) in enumerate(rows):
+                print(f"{i+1}. {title} ({plays} plays)")
+        else:
+            print("No listening history found.")
+    except Exception as e:
+        print(f"Error listing top songs: {e}")
+
+def play_from_history(n):
+    try:
+        flush_db_writes()
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('SELECT title, url FROM play_history ORDER BY started_at DESC LIMIT 1 OFFSET ?', (n - 1,))
+        song = cursor.fetchone()
+        if song:
+            play_song_from_url(song[1], song[0], 'history')
+        else:
+            print(f"No song found at position {n} in history.")
+    except Exception as e:
+        print(f"Error playing from history: {e}")
+
+# YouTube API setup: the client is built on first use, and each thread gets its own HTTP connection
+# because httplib2 is not thread-safe
+youtube = None
+youtube_lock = threading.Lock()
+http_local = threading.local()
+
+def get_youtube():
+    global youtube
+    with youtube_lock:
+        if youtube is None:
+            from googleapiclient.discovery import build
+            youtube = QuotaClient(build('youtube', 'v3', developerKey=YOUTUBE_API_KEY))
+    return youtube
+
+def execute_request(request):
+    http = getattr(http_local, 'http', None)
+    if http is None:
+        import httplib2
+        http = http_local.http = httplib2.Http(timeout=30)
+    with timed('api request'):
+        return request.execute(http=http)
+
+# API quota: every Data API call goes through one client that charges its cost against the daily budget,
+# rate-limits with a token bucket and joins callers asking for the same thing to the request already in flight.
+# Usage is counted per Pacific-time day in the api_quota table, so restarts keep the count.
+class QuotaExceeded(Exception):
+    pass
+
+QUOTA_CHARGE_SQL = '''
+    INSERT INTO api_quota (day, endpoint, units, calls) VALUES (?, ?, ?, 1)
+    ON CONFLICT (day, endpoint) DO UPDATE SET units = units + excluded.units, calls = calls + 1
+'''
+
+def get_quota_clock():
+    try:
+        from zoneinfo import ZoneInfo
+        now = datetime.datetime.now(ZoneInfo(QUOTA_TIMEZONE))
+    except Exception:
+        now = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=-8)))
+    return now.date().isoformat(), (now.hour * 3600 + now.minute * 60 + now.second) / 86400
+
+def load_quota_usage(day):
+    try:
+        cursor = get_db().cursor()
+        cursor.execute('SELECT endpoint, units, calls FROM api_quota WHERE day = ?', (day,))
+        return {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+    except Exception as e:
+        print(f"Error reading API quota usage: {e}")
+        return {}
+
+def is_quota_error(error):
+    if isinstance(error, QuotaExceeded):
+        return True
+    from googleapiclient.errors import HttpError
+    return isinstance(error, HttpError) and error.resp.status == 403 and any(reason in error.content for reason in (b'quotaExceeded', b'dailyLimitExceeded'))
+
+class QuotaClient:
+    def __init__(self, service):
+        self.service = service
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.day = None
+        self.usage = {}
+        self.exhausted = False
+        self.coalesced = 0
+        self.degraded = 0
+        self.tokens = config['api_burst']
+        self.refilled_at = time.monotonic()
+
+    def list(self, endpoint, etag=None, **params):
+        key = (endpoint, etag, tuple(sorted(params.items())))
+        with self.lock:
+            future = self.in_flight.get(key)
+            joined = future is not None
+            if joined:
+                self.coalesced += 1
+            else:
+                future = self.in_flight[key] = Future()
+        if not joined:
+            try:
+                future.set_result(self.execute(endpoint, etag, params))
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                with self.lock:
+                    del self.in_flight[key]
+        return future.result()
+
+    def execute(self, endpoint, etag, params):
+        self.charge(endpoint)
+        self.wait_for_token()
+        request = getattr(self.service, endpoint)().list(**params)
+        if etag:
+            request.headers['If-None-Match'] = etag
+        try:
+            return execute_request(request)
+        except Exception as e:
+            if is_quota_error(e):
+                with self.lock:
+                    self.exhausted = True
+            raise
+
+    # Called with the lock held
+    def roll_day(self):
+        day, _ = get_quota_clock()
+        if day != self.day:
+            self.day = day
+            self.usage = load_quota_usage(day)
+            self.exhausted = False
+
+    def used(self):
+        return sum(units for units, _ in self.usage.values())
+
+    # Expensive calls stop short of the reserve so cheap playlist and metadata calls keep working after searches run out
+    def charge(self, endpoint):
+        cost = QUOTA_COSTS.get(endpoint, 1)
+        reserve = config['api_quota_reserve'] if cost > 1 else 0
+        with self.lock:
+            self.roll_day()
+            if self.exhausted or self.used() + cost > config['api_daily_quota'] - reserve:
+                raise QuotaExceeded("YouTube API quota used up until midnight Pacific time")
+            units, calls = self.usage.get(endpoint, (0, 0))
+            self.usage[endpoint] = (units + cost, calls + 1)
+            day = self.day
+        queue_db_write(QUOTA_CHARGE_SQL, (day, endpoint, cost))
+
+    def wait_for_token(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(config['api_burst'], self.tokens + (now - self.refilled_at) * config['api_requests_per_second'])
+                self.refilled_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / config['api_requests_per_second']
+            time.sleep(delay)
+
+    # True once spending is ahead of an even pace across the day (plus the reserve as headroom) or the call
+    # would not fit; callers then answer from whatever they have cached, however old
+    def is_budget_low(self, endpoint):
+        cost = QUOTA_COSTS.get(endpoint, 1)
+        limit = config['api_daily_quota']
+        reserve = config['api_quota_reserve']
+        _, day_fraction = get_quota_clock()
+        with self.lock:
+            self.roll_day()
+            used = self.used()
+            exhausted = self.exhausted
+        allowance = min(limit * day_fraction + reserve, limit - (reserve if cost > 1 else 0))
+        return exhausted or used + cost > allowance
+
+    def record_degraded(self):
+        with self.lock:
+            self.degraded += 1
+
+    def get_usage(self):
+        with self.lock:
+            self.roll_day()
+            return {'day': self.day, 'used': self.used(), 'endpoints': dict(self.usage), 'exhausted': self.exhausted,
+                    'coalesced': self.coalesced, 'degraded': self.degraded}
+
+def display_quota():
+    try:
+        usage = get_youtube().get_usage()
+    except Exception as e:
+        print(f"Error reading API quota usage: {e}")
+        return
+    limit = config['api_daily_quota']
+    print(f"YouTube API quota for {usage['day']} (Pacific time): {usage['used']} of {limit} units used, {max(limit - usage['used'], 0)} left")
+    _, day_fraction = get_quota_clock()
+    if usage['used'] and day_fraction > 0.05:
+        print(f"At this rate the day ends at about {round(usage['used'] / day_fraction)} units.")
+    if usage['exhausted']:
+        print("YouTube reported the quota as exhausted; searches use cached and library results until it resets.")
+    for endpoint, (units, calls) in sorted(usage['endpoints'].items()):
+        print(f"  {endpoint:<16}{calls:>6} calls{units:>8} units")
+    print(f"Requests joined to an identical one in flight: {usage['coalesced']}")
+    print(f"Searches answered from cache to save quota: {usage['degraded']}")
+
+# Video metadata: titles, channels and durations, fetched up to 50 IDs per videos().list call and kept in the
+# tracks table so displays never call the API per track
+metadata_pending = set()
+metadata_lock = threading.Lock()
+metadata_job_scheduled = False
+
+def parse_iso_duration(value):
+    match = re.fullmatch(r'P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?', value or '')
+    if not match:
+        return None
+    days, hours, minutes, seconds = (int(part or 0) for part in match.groups())
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+def format_track_details(duration, channel):
+    details = [part for part in (duration and format_duration(duration), channel) if part]
+    return f" [{', '.join(details)}]" if details else ""
+
+def get_track_details(video_id):
+    try:
+        cursor = get_db().cursor()
+        cursor.execute('SELECT title, channel, duration FROM tracks WHERE video_id = ? AND metadata_at IS NOT NULL', (video_id,))
+        return cursor.fetchone()
+    except Exception as e:
+        print(f"Error reading track details: {e}")
+        return None
+
+def fetch_video_metadata(video_ids):
+    response = get_youtube().list(
+        'videos',
+        part='snippet,contentDetails',
+        id=','.join(video_ids)
+    )
+    return {item['id']: (item['snippet']['title'], item['snippet'].get('channelTitle'), parse_iso_duration(item.get('contentDetails', {}).get('duration')))
+            for item in response.get('items', [])}
+
+METADATA_UPSERT_SQL = '''
+    INSERT INTO tracks (video_id, title, search_title, url, last_seen, channel, duration, metadata_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (video_id) DO UPDATE SET
+        title = excluded.title, search_title = excluded.search_title,
+        channel = excluded.channel, duration = excluded.duration, metadata_at = excluded.metadata_at
+'''
+
+def store_video_metadata(video_ids, metadata):
+    now = time.time()
+    titles = [(transliterate(title), video_id) for video_id, (title, _, _) in metadata.items()]
+    conn = get_db()
+    with conn:
+        conn.executemany(METADATA_UPSERT_SQL, [(video_id, title, transliterate(title), f"https://www.youtube.com/watch?v={video_id}", now, channel, duration, now)
+                                               for video_id, (title, channel, duration) in metadata.items()])
+        # Deleted and private videos come back empty; mark them so the backfill does not ask again
+        conn.executemany('UPDATE tracks SET metadata_at = ? WHERE video_id = ?', [(now, video_id) for video_id in video_ids if video_id not in metadata])
+        # Rows saved with the URL standing in for the title get the real one
+        conn.executemany('UPDATE songs SET title = ? WHERE video_id = ? AND title = url', titles)
+        conn.executemany('UPDATE play_history SET title = ? WHERE video_id = ? AND title = url', [(title, video_id) for video_id, (title, _, _) in metadata.items()])
+        row = conn.execute('SELECT url FROM last_played WHERE id = 1 AND title = url').fetchone()
+        if row and get_video_id(row[0]) in metadata:
+            conn.execute('UPDATE last_played SET title = ? WHERE id = 1', (metadata[get_video_id(row[0])][0],))
+    with tracks_lock:
+        for video_id, (title, _, _) in metadata.items():
+            track = tracks_by_id.get(video_id)
+            if track is not None:
+                track.title = title
+    if radio_index is not None:
+        for video_id, (title, channel, _) in metadata.items():
+            radio_index.add(video_id, title, f"https://www.youtube.com/watch?v={video_id}", channel)
+
+def request_metadata(video_ids):
+    global metadata_job_scheduled
+    with metadata_lock:
+        metadata_pending.update(video_id for video_id in video_ids if VIDEO_ID_PATTERN.fullmatch(video_id))
+        if metadata_job_scheduled or not metadata_pending:
+            return
+        metadata_job_scheduled = True
+    api_executor.submit(run_metadata_batches)
+
+def run_metadata_batches():
+    global metadata_job_scheduled
+    while True:
+        with metadata_lock:
+            batch = [metadata_pending.pop() for _ in range(min(METADATA_BATCH_SIZE, len(metadata_pending)))]
+            if not batch:
+                metadata_job_scheduled = False
+                return
+        try:
+            store_video_metadata(batch, fetch_video_metadata(batch))
+        except Exception as e:
+            # Leave the rest for the next backfill rather than retrying against a failing API
+            print(f"Error fetching video metadata: {e}")
+            with metadata_lock:
+                metadata_pending.clear()
+                metadata_job_scheduled = False
+            return
+
+# Queue every catalog track that has never had its metadata fetched
+def backfill_metadata():
+    try:
+        cursor = get_db().cursor()
+        cursor.execute('SELECT video_id FROM tracks WHERE metadata_at IS NULL')
+        request_metadata([row[0] for row in cursor.fetchall()])
+    except Exception as e:
+        print(f"Error starting metadata backfill: {e}")
+
+# Search the local track catalog; prefix-matches every word of the transliterated query
+@timed('db local search')
+def search_local(query):
+    terms = transliterate(query).split()
+    if not fts_enabled or not terms:
+        return []
+    try:
+        match = ' '.join('"' + term.replace('"', '""') + '"*' for term in terms)
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT tracks.title, tracks.url FROM tracks_fts
+            JOIN tracks ON tracks.id = tracks_fts.rowid
+            WHERE tracks_fts MATCH ? ORDER BY bm25(tracks_fts) LIMIT 5
+        ''', (match,))
+        return [{'title': row[0], 'url': row[1]} for row in cursor.fetchall()]
+    except Exception as e:
+        print(f"Error searching local library: {e}")
+        return []
+
+# Search result cache
+@timed('db search cache read')
+def get_cached_search(query, stale_ok=False):
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('SELECT results, fetched_at FROM search_cache WHERE query = ?', (query,))
+        row = cursor.fetchone()
+        if row and (stale_ok or time.time() - row[1] < config['search_cache_ttl']):
+            return json.loads(row[0])
+    except Exception as e:
+        print(f"Error reading search cache: {e}")
+    return None
+
+@timed('db search cache write')
+def cache_search(query, results):
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('INSERT OR REPLACE INTO search_cache (query, results, fetched_at) VALUES (?, ?, ?)', (query, json.dumps(results), time.time()))
+        conn.commit()
+    except Exception as e:
+        print(f"Error writing search cache: {e}")
+
+@timed('search')
+def search_youtube(query, refresh=False):
+    cache_key = ' '.join(transliterate(query).lower().split())
+    cached = None if refresh else get_cached_search(cache_key)
+    if cached is not None:
+        return cached
+    try:
+        api = get_youtube()
+        # A search costs 100 units; once spending runs ahead of the day, an expired cache entry is good enough
+        if not refresh and api.is_budget_low('search'):
+            cached = get_cached_search(cache_key, stale_ok=True)
+            if cached is not None:
+                api.record_degraded()
+                return cached
+        response = api.list(
+            'search',
+            part='snippet',
+            q=query,
+            type='video',
+            maxResults=5
+        )
+        results = [{'title': item['snippet']['title'], 'url': f"https://www.youtube.com/watch?v={item['id']['videoId']}"} for item in response['items']]
+        cache_search(cache_key, results)
+        index_tracks(results)
+        return results
+    except Exception as e:
+        if is_quota_error(e):
+            return search_without_quota(query, cache_key)
+        print(f"Error searching YouTube: {e}")
+        return []
+
+def search_without_quota(query, cache_key):
+    results = get_cached_search(cache_key, stale_ok=True) or search_local(query)
+    if results:
+        print("YouTube API quota is used up; showing cached and library results.")
+    else:
+        print("YouTube API quota is used up until midnight Pacific time; play a YouTube URL directly or try again later.")
+    return results
+
+# Expiry timestamp googlevideo embeds in resolved stream URLs
+def get_stream_expiry(streaming_url):
+    parsed = urllib.parse.urlparse(streaming_url)
+    expire = urllib.parse.parse_qs(parsed.query).get('expire', [None])[0]
+    if expire is None and '/expire/' in parsed.path:
+        expire = parsed.path.split('/expire/')[1].split('/')[0]
+    try:
+        return int(expire)
+    except (TypeError, ValueError):
+        return int(time.time()) + STREAM_DEFAULT_TTL
+
+# Stream URL cache
+@timed('db stream cache read')
+def get_cached_stream_url(video_id):
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('SELECT stream_url, expires_at, abr FROM stream_cache WHERE video_id = ?', (video_id,))
+        row = cursor.fetchone()
+        if row and row[1] - STREAM_EXPIRY_MARGIN > time.time():
+            if not fits_bitrate(row[2], get_bitrate_cap()):
+                return None  # Resolved before quality was stepped down; kept for when it steps back up
+            queue_db_write('UPDATE stream_cache SET last_used = ? WHERE video_id = ?', (time.time(), video_id))
+            return row[0]
+        elif row:
+            queue_db_write('DELETE FROM stream_cache WHERE video_id = ?', (video_id,))
+        return None
+    except Exception as e:
+        print(f"Error reading stream cache: {e}")
+        return None
+
+@timed('db stream cache write')
+def cache_stream_url(video_id, streaming_url, abr=None):
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('INSERT OR REPLACE INTO stream_cache (video_id, stream_url, expires_at, last_used, abr) VALUES (?, ?, ?, ?, ?)',
+                       (video_id, streaming_url, get_stream_expiry(streaming_url), time.time(), abr))
+        # Evict expired entries, then everything beyond the configured size in LRU order
+        cursor.execute('DELETE FROM stream_cache WHERE expires_at - ? <= ?', (STREAM_EXPIRY_MARGIN, time.time()))
+        cursor.execute('''
+            DELETE FROM stream_cache WHERE video_id NOT IN (
+                SELECT video_id FROM stream_cache ORDER BY last_used DESC LIMIT ?
+            )
+        ''', (config['stream_cache_size'],))
+        conn.commit()
+    except Exception as e:
+        print(f"Error writing stream cache: {e}")
+
+# On-disk audio cache: downloaded tracks stored as <dir>/<id[:2]>/<id>.<ext>
+def get_cached_audio_path(video_id):
+    if not config['audio_cache_enabled']:
+        return None
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('SELECT path FROM audio_cache WHERE video_id = ?', (video_id,))
+        row = cursor.fetchone()
+        if row and os.path.exists(row[0]):
+            queue_db_write('UPDATE audio_cache SET last_used = ? WHERE video_id = ?', (time.time(), video_id))
+            return row[0]
+        elif row:
+            queue_db_write('DELETE FROM audio_cache WHERE video_id = ?', (video_id,))
+    except Exception as e:
+        print(f"Error reading audio cache: {e}")
+    return None
+
+def should_cache_audio(video_id, url):
+    conn = get_db()
+    cursor = conn.cursor()
+    if config['audio_cache_favorites']:
+        cursor.execute('SELECT 1 FROM songs WHERE url = ? AND is_favorite = 1', (url,))
+        if cursor.fetchone():
+            return True
+    cursor.execute('SELECT plays FROM play_counts WHERE video_id = ?', (video_id,))
+    row = cursor.fetchone()
+    return row is not None and row[0] >= config['audio_cache_min_plays']
+
+# Ahead downloads are for favorites that have not played yet; they only fill free space and never evict
+def schedule_audio_download(youtube_url, ahead=False):
+    video_id = get_video_id(youtube_url)
+    if not config['audio_cache_enabled'] or not video_id:
+        return
+    with audio_download_lock:
+        if video_id in audio_downloads:
+            return
+        audio_downloads.add(video_id)
+    audio_download_executor.submit(download_audio, youtube_url, video_id, ahead)
+
+# Favorites are cached a few tracks ahead of the cursor as they play, not the whole library at once
+def schedule_favorite_downloads():
+    if not config['audio_cache_enabled'] or not config['audio_cache_favorites']:
+        return
+    for song in state.playlist.upcoming(config['prefetch_count']):
+        if song.source == 'favorites':
+            schedule_audio_download(song.url, ahead=True)
+
+def is_audio_cache_full():
+    cursor = get_db().cursor()
+    cursor.execute('SELECT COALESCE(SUM(size), 0) FROM audio_cache')
+    return cursor.fetchone()[0] >= config['audio_cache_max_bytes']
+
+def download_audio(youtube_url, video_id, ahead=False):
+    try:
+        if get_cached_audio_path(video_id) or not should_cache_audio(video_id, youtube_url):
+            return
+        if ahead and is_audio_cache_full():
+            return
+        limit = config['max_audio_bitrate']
+        ydl_opts = {
+            'format': f'bestaudio[abr<={limit}]/bestaudio/best' if limit else 'bestaudio/best',
+            'quiet': True,
+            'no_warnings': True,
+            'outtmpl': os.path.join(config['audio_cache_dir'], video_id[:2], '%(id)s.%(ext)s'),
+            'progress_hooks': [record_download_progress],
+        }
+        from yt_dlp import YoutubeDL
+        with YoutubeDL(ydl_opts) as ydl:
+            info_dict = ydl.extract_info(youtube_url, download=True)
+            path = ydl.prepare_filename(info_dict)
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('INSERT OR REPLACE INTO audio_cache (video_id, path, size, last_used) VALUES (?, ?, ?, ?)',
+                       (video_id, path, os.path.getsize(path), time.time()))
+        conn.commit()
+        if not ahead:
+            evict_audio_cache()
+    except Exception as e:
+        print(f"Error caching audio: {e}")
+    finally:
+        with audio_download_lock:
+            audio_downloads.discard(video_id)
+
+# Loudness analysis: each video is measured once in a low-priority worker process, never on the playback path.
+# Integrated loudness follows ITU-R BS.1770: K-weighted mean square over 400 ms blocks overlapping by 75%,
+# gated at -70 LUFS and then 10 LU below the mean of the blocks that passed
+K_WEIGHTING_FILTERS = (
+    ((1.53512485958697, -2.69169618940638, 1.19839281085285), (1.0, -1.69065929318241, 0.73248077421585)),  # High shelf
+    ((1.0, -2.0, 1.0), (1.0, -1.99004745483398, 0.99007225036621)),  # High-pass
+)
+loudness_pool = None
+loudness_pending = set()
+loudness_lock = threading.Lock()
+loudness_unavailable = False
+
+def lower_priority():
+    if hasattr(os, 'nice'):
+        os.nice(10)
+
+# Streams the decoded audio through the filters 10 s at a time, keeping only per-100 ms energies
+def measure_loudness(segment):
+    import numpy
+    try:
+        from scipy.signal import lfilter
+    except ImportError:
+        lfilter = None  # Unweighted energy reads bass-heavy tracks a little loud, which still beats no normalization
+    step = LOUDNESS_SAMPLE_RATE // 10
+    channels = segment.channels
+    frames = numpy.frombuffer(segment.raw_data, dtype='<i2').reshape(-1, channels)
+    filter_states = [numpy.zeros((2, channels)) for _ in K_WEIGHTING_FILTERS]
+    energies = []
+    peak = 0.0
+    for start in range(0, len(frames), step * 100):
+        samples = frames[start:start + step * 100].astype(numpy.float64) / 32768
+        peak = max(peak, float(numpy.abs(samples).max()))
+        if lfilter:
+            for index, (b, a) in enumerate(K_WEIGHTING_FILTERS):
+                samples, filter_states[index] = lfilter(b, a, samples, axis=0, zi=filter_states[index])
+        usable = len(samples) - len(samples) % step
+        energies.append((samples[:usable] ** 2).reshape(-1, step, channels).sum(axis=(1, 2)))
+    peak_db = 20 * math.log10(peak) if peak > 0 else None
+    energy = numpy.concatenate(energies) if energies else numpy.zeros(0)
+    if len(energy) < 4:
+        return None, peak_db
+    powers = (energy[:-3] + energy[1:-2] + energy[2:-1] + energy[3:]) / (4 * step)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        powers = powers[-0.691 + 10 * numpy.log10(powers) > -70]
+        if not powers.size:
+            return None, peak_db
+        relative_gate = -0.691 + 10 * math.log10(powers.mean()) - 10
+        powers = powers[-0.691 + 10 * numpy.log10(powers) > relative_gate]
+    return -0.691 + 10 * math.log10(powers.mean()), peak_db
+
+# Runs in the worker process; returns (integrated LUFS, peak dBFS), either None for silence
+def analyze_loudness(youtube_url, local_path=None):
+    if not shutil.which('ffmpeg'):
+        raise ImportError("ffmpeg is not installed")
+    import numpy  # Fail before downloading anything when it is missing
+    from pydub import AudioSegment
+    work_dir = None
+    try:
+        path = local_path
+        if not path:
+            # The smallest audio format measures close enough to the best one for a fraction of the download
+            work_dir = tempfile.mkdtemp(prefix='loudness')
+            from yt_dlp import YoutubeDL
+            ydl_opts = {
+                'format': 'worstaudio/worst',
+                'quiet': True,
+                'no_warnings': True,
+                'outtmpl': os.path.join(work_dir, '%(id)s.%(ext)s'),
+            }
+            with YoutubeDL(ydl_opts) as ydl:
+                path = ydl.prepare_filename(ydl.extract_info(youtube_url, download=True))
+        segment = AudioSegment.from_file(path).set_sample_width(2).set_frame_rate(LOUDNESS_SAMPLE_RATE)
+        return measure_loudness(segment)
+    finally:
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+def schedule_loudness_analysis(song):
+    video_id = song.video_id
+    if not config['loudness_normalization'] or loudness_unavailable or not video_id or not VIDEO_ID_PATTERN.fullmatch(video_id):
+        return
+    with loudness_lock:
+        if video_id in loudness_pending:
+            return
+        loudness_pending.add(video_id)
+    job_executor.submit(start_loudness_analysis, song.url, video_id)
+
+def start_loudness_analysis(youtube_url, video_id):
+    global loudness_pool
+    try:
+        cursor = get_db().cursor()
+        cursor.execute('SELECT 1 FROM track_loudness WHERE video_id = ?', (video_id,))
+        if cursor.fetchone():
+            with loudness_lock:
+                loudness_pending.discard(video_id)
+            return
+        with loudness_lock:
+            if loudness_pool is None:
+                import multiprocessing
+                # Spawned rather than forked: forking a process that runs VLC and a dozen threads is not safe.
+                # A pool, unlike ProcessPoolExecutor, is terminated at exit instead of waited for
+                loudness_pool = multiprocessing.get_context('spawn').Pool(processes=1, initializer=lower_priority)
+            pool = loudness_pool
+        pool.apply_async(analyze_loudness, (youtube_url, get_cached_audio_path(video_id)),
+                         callback=functools.partial(store_loudness, video_id),
+                         error_callback=functools.partial(on_loudness_error, video_id))
+    except Exception as e:
+        print(f"Error starting loudness analysis: {e}")
+        with loudness_lock:
+            loudness_pending.discard(video_id)
+
+def store_loudness(video_id, result):
+    integrated, peak = result
+    queue_db_write('INSERT OR REPLACE INTO track_loudness (video_id, integrated, peak, analyzed_at) VALUES (?, ?, ?, ?)',
+                   (video_id, integrated, peak, time.time()))
+    with loudness_lock:
+        loudness_pending.discard(video_id)
+
+def on_loudness_error(video_id, error):
+    global loudness_unavailable
+    if isinstance(error, ImportError):
+        if not loudness_unavailable:
+            print(f"Loudness normalization disabled, analysis needs numpy, pydub and ffmpeg: {error}")
+        loudness_unavailable = True
+    else:
+        print(f"Error analyzing loudness: {error}")
+    with loudness_lock:
+        loudness_pending.discard(video_id)
+
+# Remove least recently used files until the cache fits its byte budget
+def evict_audio_cache():
+    conn = get_db()
+    cursor = conn.cursor()
+    cursor.execute('SELECT COALESCE(SUM(size), 0) FROM audio_cache')
+    total = cursor.fetchone()[0]
+    if total <= config['audio_cache_max_bytes']:
+        return
+    cursor.execute('SELECT video_id, path, size FROM audio_cache ORDER BY last_used')
+    evicted = []
+    for video_id, path, size in cursor.fetchall():
+        if total <= config['audio_cache_max_bytes']:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        evicted.append((video_id,))
+        total -= size
+    cursor.executemany('DELETE FROM audio_cache WHERE video_id = ?', evicted)
+    conn.commit()
+
+@timed('extract')
+def extract_streaming_url(youtube_url):
+    video_id = get_video_id(youtube_url) or youtube_url
+    local_path = get_cached_audio_path(video_id)
+    if local_path:
+        return local_path
+    cached_url = get_cached_stream_url(video_id)
+    if cached_url:
+        return cached_url
+    with prefetch_lock:
+        future = prefetch_futures.pop(video_id, None)
+    # Wait for a prefetch already resolving this track instead of starting a second extraction; a finished
+    # one has already been offered through the stream cache, which turns down URLs above the bitrate cap
+    if future and not future.done() and not future.cancel():
+        try:
+            streaming_url = future.result()
+            if streaming_url:
+                return streaming_url
+        except Exception:
+            pass
+    return resolve_streaming_url(youtube_url, video_id, hedge=True)
+
+# Extractor pools: warmed YoutubeDL instances keep their extractor, player JS and HTTP caches between calls.
+# The 'alt' pool asks YouTube for other player clients, which tend to break independently of the web client
+extractor_pools = {}
+extractors_created = {}
+extractor_pool_lock = threading.Lock()
+
+# Batch and prefetch resolves share all but one extractor per pool, so an interactive play never queues behind them
+background_resolve_slots = threading.BoundedSemaphore(max(1, config['extractor_pool_size'] - 1))
+batch_executor = ThreadPoolExecutor(max_workers=max(1, config['extractor_pool_size'] - 1), thread_name_prefix='batch')
+
+def create_extractor(strategy):
+    ydl_opts = {
+        'format': 'bestaudio/best',
+        'quiet': True,
+        'no_warnings': True,
+        'socket_timeout': config['resolve_timeout'],
+    }
+    if strategy == 'alt':
+        ydl_opts['extractor_args'] = {'youtube': {'player_client': list(ALT_PLAYER_CLIENTS)}}
+    else:
+        ydl_opts['force_generic_extractor'] = True
+    if config['extractor_cache_dir']:
+        ydl_opts['cachedir'] = config['extractor_cache_dir']
+    from yt_dlp import YoutubeDL
+    return YoutubeDL(ydl_opts)
+
+@contextlib.contextmanager
+def borrow_extractor(strategy='default'):
+    with extractor_pool_lock:
+        pool = extractor_pools.setdefault(strategy, Queue())
+    try:
+        ydl = pool.get_nowait()
+    except Empty:
+        with extractor_pool_lock:
+            can_create = extractors_created.get(strategy, 0) < config['extractor_pool_size']
+            if can_create:
+                extractors_created[strategy] = extractors_created.get(strategy, 0) + 1
+        ydl = create_extractor(strategy) if can_create else pool.get()
+    try:
+        yield ydl
+    finally:
+        pool.put(ydl)
+
+# Circuit breakers, one per resolver backend: closed while it works, open (skipped) for CIRCUIT_COOLDOWN seconds
+# after CIRCUIT_FAILURE_LIMIT failures in a row, then half-open to let one trial call decide
+circuits = {backend: {'failures': 0, 'opened_at': None, 'trial': False} for backend in RESOLVER_BACKENDS}
+missing_backends = set()  # Backends whose library is not installed
+circuits_lock = threading.Lock()
+
+# Resolver backend attempts; callers wait on them with a deadline, so a stuck extraction never holds up a caller
+resolver_executor = ThreadPoolExecutor(max_workers=config['extractor_pool_size'] * len(RESOLVER_BACKENDS), thread_name_prefix='resolve')
+
+def claim_backend(backend):
+    with circuits_lock:
+        circuit = circuits[backend]
+        if backend in missing_backends:
+            return False
+        if circuit['opened_at'] is None:
+            return True
+        if circuit['trial'] or time.monotonic() - circuit['opened_at'] < CIRCUIT_COOLDOWN:
+            return False
+        circuit['trial'] = True
+        return True
+
+def record_backend_result(backend, error=None):
+    with circuits_lock:
+        circuit = circuits[backend]
+        circuit['trial'] = False
+        if error is None:
+            circuit['failures'] = 0
+            circuit['opened_at'] = None
+            return
+        circuit['failures'] += 1
+        if circuit['opened_at'] is None and circuit['failures'] < CIRCUIT_FAILURE_LIMIT:
+            return
+        if circuit['opened_at'] is None:
+            print(f"Stream backend {backend} keeps failing; skipping it for {CIRCUIT_COOLDOWN}s: {error}")
+        circuit['opened_at'] = time.monotonic()
+
+# Errors about the video itself fail on every backend and say nothing about the backend's health
+def is_video_error(error):
+    return bool(VIDEO_ERROR_PATTERN.search(str(error)))
+
+def extract_with_pytube(youtube_url):
+    from pytube import YouTube
+    formats = [{'url': stream.url, 'abr': int(stream.abr.rstrip('kbps')) if stream.abr else 0, 'acodec': stream.audio_codec, 'vcodec': 'none'}
+               for stream in YouTube(youtube_url).streams.filter(only_audio=True)]
+    audio_format = select_audio_format(formats, get_bitrate_cap())
+    if audio_format is None:
+        raise ValueError("pytube found no audio streams")
+    return audio_format
+
+def run_resolver_backend(backend, youtube_url, video_id):
+    try:
+        if backend == 'pytube':
+            audio_format = extract_with_pytube(youtube_url)
+        else:
+            with borrow_extractor('alt' if backend == 'yt-dlp alt' else 'default') as ydl:
+                info_dict = ydl.extract_info(youtube_url, download=False)
+            audio_format = select_audio_format(info_dict.get('formats') or [], get_bitrate_cap()) or info_dict
+    except ImportError:
+        with circuits_lock:
+            missing_backends.add(backend)
+        raise
+    except Exception as e:
+        record_backend_result(backend, None if is_video_error(e) else e)
+        raise
+    record_backend_result(backend)
+    # Cached even when the caller has given up or a hedged attempt won, so the next play finds it
+    cache_stream_url(video_id, audio_format['url'], get_format_bitrate(audio_format) or None)
+    return audio_format['url']
+
+# Try backends in order with a hard deadline: fail over as soon as an attempt fails, and when hedging, start the
+# next backend alongside the first once it has run resolve_hedge_after seconds; the first URL back wins
+def resolve_streaming_url(youtube_url, video_id, hedge=False):
+    deadline = time.monotonic() + config['resolve_deadline']
+    hedge_at = None
+    backends = iter(RESOLVER_BACKENDS)
+    pending = set()
+    error = None
+    with timed('resolve'):
+        while True:
+            now = time.monotonic()
+            if not pending or (hedge_at is not None and now >= hedge_at):
+                backend = next((backend for backend in backends if claim_backend(backend)), None)
+                if backend:
+                    pending.add(resolver_executor.submit(run_resolver_backend, backend, youtube_url, video_id))
+                elif not pending:
+                    break
+                # The hedge clock runs while a single attempt is in flight, restarting when a failover replaces it
+                hedge_at = now + config['resolve_hedge_after'] if hedge and len(pending) == 1 else None
+            if now >= deadline:
+                error = f"no stream after {config['resolve_deadline']}s"
+                break
+            timeout = min(deadline, hedge_at) - now if hedge_at is not None else deadline - now
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+            if error is not None and is_video_error(error):
+                break
+    print(f"Error extracting streaming URL: {error or 'every stream backend is paused after repeated failures'}")
+    return None
+
+# Stream format selection from the formats yt-dlp returns
+def get_format_bitrate(audio_format):
+    return audio_format.get('abr') or audio_format.get('tbr') or 0
+
+# Bitrate steps are nominal; real formats land a little above them (YouTube's 128k AAC reports ~130)
+def fits_bitrate(abr, cap):
+    return not abr or not cap or abr <= cap * 1.1
+
+# Prefer audio-only streams over muxed video, the highest bitrate that fits the cap, then the cheapest codec
+def select_audio_format(formats, cap):
+    playable = [f for f in formats if f.get('url') and f.get('acodec') != 'none' and f.get('protocol', 'https') in ('http', 'https')]
+    audio_only = [f for f in playable if f.get('vcodec') == 'none']
+    candidates = audio_only or playable
+    if not candidates:
+        return None
+    def codec_rank(audio_format):
+        codec = audio_format.get('acodec') or ''
+        return next((i for i, name in enumerate(AUDIO_CODEC_PREFERENCE) if codec.startswith(name)), len(AUDIO_CODEC_PREFERENCE))
+    fitting = [f for f in candidates if fits_bitrate(get_format_bitrate(f), cap)]
+    if not fitting:
+        return min(candidates, key=get_format_bitrate)
+    return max(fitting, key=lambda f: (get_format_bitrate(f), -codec_rank(f)))
+
+# Adaptive quality: the bitrate cap for the next resolve in kbps, 0 meaning no cap
+def get_bitrate_cap():
+    limit = config['max_audio_bitrate']
+    if not config['adaptive_bitrate'] or state.bitrate_step is None:
+        return limit
+    step = AUDIO_BITRATE_STEPS[state.bitrate_step]
+    return min(step, limit) if limit else step
+
+# Called as a track starts: step quality down after stalls on the previous track or a slow link, up when there is headroom.
+# VLC's own read rate says nothing about headroom: once its small network cache fills it reads at about the stream's
+# bitrate, however fast the link is. Throughput is measured from real transfers instead: a ranged GET of each next
+# stream and audio cache downloads. Without any, quality steps back up after BITRATE_PROBE_TRACKS tracks without a stall.
+def update_bitrate_step():
+    stalls = state.stalls
+    state.stalls = 0
+    throughput = state.throughput_kbps
+    if not config['adaptive_bitrate'] or (state.bitrate_step is None and not stalls and not throughput):
+        return
+    if state.bitrate_step is None:
+        limit = config['max_audio_bitrate'] or AUDIO_BITRATE_STEPS[-1]
+        state.bitrate_step = max([i for i, step in enumerate(AUDIO_BITRATE_STEPS) if step <= limit] or [0])
+    state.clean_tracks = 0 if stalls else state.clean_tracks + 1
+    step = state.bitrate_step
+    can_step_up = step + 1 < len(AUDIO_BITRATE_STEPS) and (not config['max_audio_bitrate'] or AUDIO_BITRATE_STEPS[step + 1] <= config['max_audio_bitrate'])
+    if step > 0 and (stalls or (throughput and throughput < 2 * AUDIO_BITRATE_STEPS[step])):
+        step -= 1
+    elif can_step_up and not stalls and (throughput > 4 * AUDIO_BITRATE_STEPS[step + 1] if throughput else state.clean_tracks >= BITRATE_PROBE_TRACKS):
+        step += 1
+    if step != state.bitrate_step:
+        if stalls:
+            reason = f"{stalls} stall(s)"
+        elif throughput:
+            reason = f"~{throughput:.0f} kbps throughput"
+        else:
+            reason = f"{state.clean_tracks} tracks without a stall"
+        print(f"Stream quality set to {AUDIO_BITRATE_STEPS[step]} kbps ({reason}).")
+        state.bitrate_step = step
+        state.clean_tracks = 0
+
+def record_download_progress(progress):
+    if progress.get('status') == 'finished':
+        record_transfer(progress.get('total_bytes') or progress.get('downloaded_bytes'), progress.get('elapsed'))
+
+# Read the start of a stream as fast as the link allows, timed from the first byte so connection setup does not count
+def probe_throughput(streaming_url):
+    size = config['throughput_probe_bytes']
+    if not size or not config['adaptive_bitrate'] or not streaming_url.startswith(('http://', 'https://')):
+        return
+    import urllib.request
+    try:
+        request = urllib.request.Request(streaming_url, headers={'Range': f'bytes=0-{size - 1}'})
+        with urllib.request.urlopen(request, timeout=10) as response:
+            started = time.perf_counter()
+            received = 0
+            while received < size:
+                chunk = response.read(65536)
+                if not chunk:
+                    break
+                received += len(chunk)
+        record_transfer(received, time.perf_counter() - started)
+    except Exception:
+        pass  # Some stream hosts refuse a plain GET; the track still plays, and adaptation falls back on stalls
+
+# Fed from finished transfers on their own thread; the estimate itself is updated on the event loop
+def record_transfer(size_bytes, seconds):
+    if size_bytes and seconds and size_bytes >= THROUGHPUT_MIN_BYTES:
+        post_event(update_throughput, size_bytes * 8 / 1000 / seconds)
+
+def update_throughput(kbps):
+    state.throughput_kbps = kbps if state.throughput_kbps is None else 0.7 * state.throughput_kbps + 0.3 * kbps
+
+playback_monitor = None
+
+def start_playback_monitor():
+    global playback_monitor
+    if playback_monitor is None:
+        playback_monitor = threading.Thread(target=run_playback_monitor, name='playback-monitor', daemon=True)
+        playback_monitor.start()
+
+def run_playback_monitor():
+    while True:
+        time.sleep(1)
+        post_event(check_playback)
+
+def check_playback():
+    if state.playing and not state.loading and state.last_progress and time.perf_counter() - state.last_progress > STALL_TIMEOUT:
+        print(f"Playback stalled for {STALL_TIMEOUT} seconds.")
+        recover_stream()
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+# Resolve many songs concurrently; returns {url: streaming_url or None} and per-track resolve times in seconds
+def resolve_batch(songs, timeout=None):
+    timeout = timeout or config['resolve_timeout']
+    results = {}
+    timings = []
+    started_at = {}
+    def resolve(song):
+        started_at[song.url] = time.perf_counter()
+        return get_cached_audio_path(song.video_id) or get_cached_stream_url(song.video_id) or resolve_in_background(song.url, song.video_id)
+    futures = {batch_executor.submit(resolve, song): song for song in songs}
+    pending = set(futures)
+    while pending:
+        done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+        for future in done:
+            song = futures[future]
+            results[song.url] = None if future.exception() else future.result()
+            timings.append(time.perf_counter() - started_at[song.url])
+        for future in list(pending):
+            song = futures[future]
+            # A stuck extraction cannot be interrupted; stop waiting for it and let it finish in the background
+            if song.url in started_at and time.perf_counter() - started_at[song.url] > timeout:
+                pending.discard(future)
+                results[song.url] = None
+                print(f"Timed out resolving {song.title}")
+    return results, timings
+
+def resolve_in_background(youtube_url, video_id):
+    with background_resolve_slots:
+        return resolve_streaming_url(youtube_url, video_id)
+
+def resolve_playlist_ahead(songs):
+    limit = config['batch_resolve_limit']
+    songs = list(songs[:limit] if limit else songs)
+    if not songs:
+        return
+    def resolve():
+        started = time.perf_counter()
+        results, timings = resolve_batch(songs)
+        if timings:
+            timings.sort()
+            resolved = sum(1 for streaming_url in results.values() if streaming_url)
+            print(f"Resolved {resolved}/{len(songs)} songs in {time.perf_counter() - started:.1f}s "
+                  f"(avg {1000 * sum(timings) / len(timings):.0f} ms, p95 {1000 * percentile(timings, 0.95):.0f} ms per track)")
+    job_executor.submit(resolve)
+
+# Prefetch upcoming songs
+def prefetch_song(youtube_url, video_id):
+    return get_cached_audio_path(video_id) or get_cached_stream_url(video_id) or resolve_in_background(youtube_url, video_id)
+
+def schedule_prefetch():
+    global prefetch_executor
+    count = config['prefetch_count']
+    if count <= 0:
+        return
+    wanted = [(song.video_id, song.url) for song in state.playlist.upcoming(count)]
+    wanted_ids = {video_id for video_id, _ in wanted}
+    with prefetch_lock:
+        if prefetch_executor is None:
+            prefetch_executor = ThreadPoolExecutor(max_workers=config['prefetch_workers'], thread_name_prefix='prefetch')
+        for video_id, future in list(prefetch_futures.items()):
+            # Drop finished work, and pending work that fell out of the window so the new window runs first
+            if future.done() or (video_id not in wanted_ids and future.cancel()):
+                del prefetch_futures[video_id]
+        for video_id, url in wanted:
+            if video_id not in prefetch_futures:
+                prefetch_futures[video_id] = prefetch_executor.submit(prefetch_song, url, video_id)
+        if wanted:
+            prefetch_futures[wanted[0][0]].add_done_callback(preload_from_future)
+
+def cancel_prefetch():
+    with prefetch_lock:
+        for video_id, future in list(prefetch_futures.items()):
+            if future.cancel() or future.done():
+                del prefetch_futures[video_id]
+
+# VLC player engine: one instance and two media players for the whole session, the audible one in state.player
+vlc_lock = threading.Lock()
+
+def get_vlc_instance():
+    global vlc, vlc_instance
+    with vlc_lock:
+        if vlc_instance is None:
+            import vlc
+            vlc_instance = vlc.Instance('--no-video', '--quiet')
+    return vlc_instance
+
+def get_vlc_player():
+    get_vlc_instance()
+    if state.player is None:
+        state.player = create_player()
+        if state.volume is None:
+            state.volume = config['volume']
+        state.player.audio_set_volume(state.volume)
+        start_playback_monitor()
+    return state.player
+
+def create_player():
+    player = vlc_instance.media_player_new()
+    player_events = player.event_manager()
+    player_events.event_attach(vlc.EventType.MediaPlayerEndReached, on_player_event, player, on_media_finished)
+    player_events.event_attach(vlc.EventType.MediaPlayerTimeChanged, on_player_event, player, on_time_changed)
+    player_events.event_attach(vlc.EventType.MediaPlayerLengthChanged, on_player_event, player, on_length_changed)
+    player_events.event_attach(vlc.EventType.MediaPlayerPlaying, on_player_event, player, on_playing_changed, True)
+    player_events.event_attach(vlc.EventType.MediaPlayerPaused, on_player_event, player, on_playing_changed, False)
+    player_events.event_attach(vlc.EventType.MediaPlayerStopped, on_player_event, player, on_playing_changed, False)
+    player_events.event_attach(vlc.EventType.MediaPlayerBuffering, on_player_event, player, on_buffering)
+    player_events.event_attach(vlc.EventType.MediaPlayerEncounteredError, on_player_event, player, on_media_error)
+    return player
+
+# Both players report events; only the audible one's move the position model
+def on_player_event(event, player, handler, *args):
+    if player is state.player:
+        handler(event, *args)
+
+# Position model updates; these only store values, so they are safe on VLC's event thread
+def on_time_changed(event):
+    state.time_ms = event.u.new_time
+    state.last_progress = time.perf_counter()
+    if state.reopened_at_ms is not None and state.time_ms > state.reopened_at_ms:
+        state.reopened_at_ms = None
+        state.recovery_attempts = 0
+
+def on_length_changed(event):
+    state.length_ms = event.u.new_length
+
+# A drop below a full buffer after playback started is a stall
+def on_buffering(event):
+    if event.u.new_cache >= 100:
+        state.buffer_full = True
+    elif state.buffer_full and state.playing:
+        state.stalls += 1
+        state.buffer_full = False
+
+def on_playing_changed(event, playing):
+    state.playing = playing
+    if playing:
+        # The first Playing event of a track is when audio starts; resumes leave the marks cleared
+        for stage, attribute in (('first audio', 'request_started'), ('buffering', 'media_started'), ('transition gap', 'track_ended_at')):
+            started = getattr(state, attribute)
+            if started is not None:
+                record_span(stage, started)
+                setattr(state, attribute, None)
+
+# Open the next song paused on the standby player, so its stream is connected and buffered before it is needed
+def preload_media(streaming_url):
+    global preloaded_media, standby_player
+    if vlc_instance is None:
+        return
+    with preload_lock:
+        if preloaded_media and preloaded_media[0] == streaming_url:
+            return
+        if standby_player is None:
+            standby_player = create_player()
+        next_media = vlc_instance.media_new(streaming_url)
+        next_media.add_option(':start-paused')
+        standby_player.set_media(next_media)
+        standby_player.play()
+        if preloaded_media:
+            preloaded_media[1].release()
+        preloaded_media = (streaming_url, next_media)
+
+# Prefetch callbacks can run on the event loop, so the work goes to a job thread
+def preload_from_future(future):
+    global preload_requested
+    if future.cancelled() or future.exception() or not future.result():
+        return
+    with preload_lock:
+        if preload_requested == future.result():
+            return
+        preload_requested = future.result()
+    job_executor.submit(preload_next, future.result())
+
+# The probe waits for the standby to finish buffering, so it does not share the link with VLC's own reads
+def preload_next(streaming_url):
+    preload_media(streaming_url)
+    deadline = time.monotonic() + 5
+    while standby_player is not None and standby_player.get_state() != vlc.State.Paused and time.monotonic() < deadline:
+        time.sleep(0.1)
+    probe_throughput(streaming_url)
+
+# Make the standby player audible if it holds this URL and has finished opening; the old player becomes the standby
+def swap_to_standby(streaming_url):
+    global preloaded_media, standby_player
+    with preload_lock:
+        if not preloaded_media or preloaded_media[0] != streaming_url or standby_player.get_state() != vlc.State.Paused:
+            return None
+        next_media = preloaded_media[1]
+        preloaded_media = None
+        outgoing = state.player
+        state.player = standby_player
+        standby_player = outgoing
+        outgoing.stop()
+        return next_media
+
+def release_preloaded_media():
+    global preloaded_media, preload_requested
+    with preload_lock:
+        preload_requested = None
+        if preloaded_media:
+            standby_player.stop()
+            preloaded_media[1].release()
+            preloaded_media = None
+
+# Runs on VLC's event thread, which must not call back into libvlc
+def on_media_finished(event):
+    state.playing = False
+    # googlevideo ends the response early once a URL expires or is refused; that is not the end of the song
+    if is_remote_stream() and state.length_ms > 0 and state.time_ms < state.length_ms - STREAM_CUTOFF_MARGIN_MS:
+        post_event(recover_stream)
+        return
+    state.track_ended_at = time.perf_counter()
+    post_event(advance_after_media_finished, state.play_request)
+
+def on_media_error(event):
+    state.playing = False
+    if is_remote_stream():
+        post_event(recover_stream)
+        return
+    # A file from the audio cache has no stream to re-resolve; move on as if it had ended
+    print("Error: Could not play the cached audio file.")
+    post_event(advance_after_media_finished, state.play_request)
+
+def advance_after_media_finished(request_id):
+    if request_id != state.play_request:
+        return  # A next/prev/play handled before this event already moved on
+    record_history_end(ended=True)
+    if state.playlist.has_next():
+        play_next_song()
+    else:
+        state.track_ended_at = None
+        if state.playlist_mode:
+            print("Playlist completely played. Type 'playlist restart' to restart the playlist or 'close' to exit.")
+
+@timed('vlc open')
+def stream_audio_with_vlc(url, start_ms=0, video_id=None):
+    try:
+        get_vlc_player()
+        new_media = None if start_ms else swap_to_standby(url)
+        swapped = new_media is not None
+        if swapped:
+            state.player.audio_set_volume(state.volume)
+            state.equalizer_applied = True  # The standby may still carry the settings from its last track
+        else:
+            new_media = vlc_instance.media_new(url)
+            if start_ms:
+                new_media.add_option(f':start-time={start_ms / 1000:.3f}')
+            state.player.set_media(new_media)
+        apply_audio_filters(video_id)
+        if state.media:
+            state.media.release()
+        state.media = new_media
+        state.time_ms = start_ms
+        # A swapped-in player reported its length and full buffer while it was still the standby
+        state.length_ms = max(state.player.get_length(), 0) if swapped else 0
+        state.buffer_full = swapped
+        state.stream_url = url
+        state.stream_failed = False
+        state.last_progress = time.perf_counter()
+        state.media_started = time.perf_counter()
+        state.player.play()
+        update_display()
+    except Exception as e:
+        print(f"Error playing audio with VLC: {e}")
+
+# Normalization gain and the equalizer from config.yml go through VLC's equalizer as each track opens: the preamp
+# carries the track's gain, the bands the configured settings. Tracks not analyzed yet play unmodified.
+equalizer_bands = None
+
+def get_equalizer_bands():
+    global equalizer_bands
+    if equalizer_bands is None:
+        equalizer_bands = {}
+        try:
+            count = vlc.libvlc_audio_equalizer_get_band_count()
+            frequencies = [vlc.libvlc_audio_equalizer_get_band_frequency(index) for index in range(count)]
+            # Settings map a frequency in Hz to a gain in dB; each goes to the nearest of VLC's bands
+            for frequency, amp in (config['equalizer'] or {}).items():
+                index = min(range(count), key=lambda index: abs(math.log(frequencies[index] / float(frequency))))
+                equalizer_bands[index] = float(amp)
+        except Exception as e:
+            print(f"Error reading equalizer settings: {e}")
+    return equalizer_bands
+
+def get_track_gain(video_id):
+    try:
+        cursor = get_db().cursor()
+        cursor.execute('SELECT integrated, peak FROM track_loudness WHERE video_id = ?', (video_id,))
+        row = cursor.fetchone()
+    except Exception as e:
+        print(f"Error reading track loudness: {e}")
+        return 0
+    if not row or row[0] is None:
+        return 0
+    gain = config['loudness_target'] - row[0]
+    if row[1] is not None:
+        gain = min(gain, max(0, LOUDNESS_PEAK_CEILING - row[1]))
+    return max(-LOUDNESS_MAX_GAIN, min(LOUDNESS_MAX_GAIN, gain))
+
+def apply_audio_filters(video_id):
+    gain = get_track_gain(video_id) if video_id and config['loudness_normalization'] else 0
+    bands = get_equalizer_bands()
+    if not gain and not bands:
+        if state.equalizer_applied:
+            state.player.set_equalizer(None)
+            state.equalizer_applied = False
+        return
+    equalizer = vlc.AudioEqualizer()
+    equalizer.set_preamp(gain)
+    for index, amp in bands.items():
+        equalizer.set_amp_at_index(amp, index)
+    # The player copies the settings, so the equalizer can be released straight away
+    state.player.set_equalizer(equalizer)
+    equalizer.release()
+    state.equalizer_applied = True
+
+def is_remote_stream():
+    return bool(state.stream_url) and state.stream_url.startswith(('http://', 'https://'))
+
+def is_stream_expired():
+    return is_remote_stream() and (state.stream_failed or get_stream_expiry(state.stream_url) - STREAM_EXPIRY_MARGIN <= time.time())
+
+def is_paused():
+    return bool(state.history_entry and state.history_entry['paused_at'])
+
+# Re-resolve the current track after its stream URL expired or broke, and reopen it where it left off
+def recover_stream(position_ms=None):
+    song = get_current_song()
+    if song is None or state.loading or not is_remote_stream():
+        return
+    if position_ms is None and is_paused():
+        state.stream_failed = True  # Reopening now would unpause; 'resume' does it instead
+        return
+    if state.recovery_attempts >= STREAM_RECOVERY_ATTEMPTS:
+        print(f"Error: Lost the stream for {song.title}")
+        if state.playlist.has_next():
+            play_next_song()
+        return
+    state.recovery_attempts += 1
+    position_ms = state.time_ms if position_ms is None else position_ms
+    state.play_request += 1
+    state.loading = True
+    request_id = state.play_request
+    # Always extract afresh: the cached URL for this track is the one that just failed
+    run_job(functools.partial(resolve_streaming_url, hedge=True), functools.partial(finish_recover_stream, request_id, song, position_ms), song.url, song.video_id)
+
+def finish_recover_stream(request_id, song, position_ms, streaming_url):
+    if request_id != state.play_request:
+        return
+    state.loading = False
+    if streaming_url:
+        stream_audio_with_vlc(streaming_url, position_ms, song.video_id)
+        state.reopened_at_ms = position_ms
+        print(f"Reopened {song.title} at {format_duration(position_ms // 1000)}.")
+    else:
+        print(f"Error: Could not reopen {song.title}")
+        if state.playlist.has_next():
+            play_next_song()
+
+# Resolve a song off the event loop and start it once its stream URL is ready
+def start_song(song, on_failure=None, start_ms=0):
+    state.play_request += 1
+    state.loading = True
+    state.restore_ms = None
+    state.request_started = time.perf_counter()
+    request_id = state.play_request
+    run_job(extract_streaming_url, functools.partial(finish_start_song, request_id, song, on_failure=on_failure, start_ms=start_ms), song.url)
+
+def finish_start_song(request_id, song, streaming_url, on_failure, start_ms=0):
+    if request_id != state.play_request:
+        return  # A newer next/prev/play/close superseded this request
+    state.loading = False
+    if streaming_url:
+        update_bitrate_step()
+        state.recovery_attempts = 0
+        state.reopened_at_ms = None
+        state.failed_starts = 0
+        stream_audio_with_vlc(streaming_url, start_ms, song.video_id)
+        state.history_entry = {'song': song, 'source': song.source, 'started_at': time.time(), 'paused_at': None, 'paused_total': 0}
+        update_last_played(song.title, song.url)
+        display_now_playing(song.title, song.url)
+        publish('track', {'title': song.title, 'url': song.url, 'source': song.source})
+        if song.title == song.url:
+            request_metadata([song.video_id])
+        elif radio_index is not None:
+            radio_index.add(song.video_id, song.title, song.url)
+        fill_radio_queue()
+        schedule_prefetch()
+        schedule_audio_download(song.url)
+        schedule_favorite_downloads()
+        schedule_loudness_analysis(song)
+    else:
+        print(f"Error: Could not stream {song.title}")
+        state.failed_starts += 1
+        # Skipping on through a playlist while every track fails would only burn through it
+        if on_failure and state.failed_starts >= FAILED_START_LIMIT:
+            print(f"Stopped after {state.failed_starts} songs in a row failed to load. Type 'next' to try the next one.")
+        elif on_failure:
+            on_failure()
+
+def is_busy():
+    return state.loading or (state.player is not None and state.player.is_playing())
+
+def play_next_song(index=None):
+    record_history_end()
+    if state.player:
+        state.player.stop()
+    if index is not None:
+        cancel_prefetch()
+    from_queue = index is None and state.playlist.position >= len(state.playlist)
+    song = state.playlist.jump(index) if index is not None else state.playlist.advance()
+    if song:
+        start_song(song, on_failure=None if from_queue else play_next_song)
+    else:
+        if state.playlist_mode:
+            print("Playlist completely played. Type 'playlist restart' to restart the playlist or 'close' to exit.")
+        else:
+            print("No next song available in the queue.")
+
+def play_previous_song():
+    if state.player:
+        state.player.stop()
+    if state.playlist.has_position(state.playlist.position - 1):
+        play_next_song(state.playlist.position - 1)
+    elif state.playlist.queue:
+        print("No previous song available in the queue.")
+    else:
+        print("No previous song available.")
+
+# Radio: a TF-IDF index over every track the player knows (history, favorites, search results), queried with the
+# last few played tracks. Terms are hashed into a fixed number of buckets, so a new track is just appended to the
+# posting lists of its buckets and nothing is ever refit; IDF comes from live document counts at query time.
+radio_index = None
+radio_index_building = False
+
+class SimilarityIndex:
+    def __init__(self):
+        import numpy
+        self.numpy = numpy
+        self.lock = threading.Lock()
+        self.rows = {}  # video_id -> row of its current entry
+        self.docs = []  # row -> (video_id, title, url, channel, terms); replaced entries stay behind as None
+        self.alive = bytearray()
+        self.postings = {}  # bucket -> (rows, weights) as growable arrays numpy reads without copying
+        self.document_counts = {}
+        self.live = 0
+
+    @staticmethod
+    def get_terms(title, channel):
+        words = re.findall(r'\w+', transliterate(title).lower())
+        terms = words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+        # "Artist - Title" and the uploading channel both name the artist, the strongest similarity signal
+        if ' - ' in title:
+            terms += ['artist:' + transliterate(title.split(' - ')[0]).lower().strip()] * 2
+        if channel:
+            terms += ['channel:' + transliterate(channel).lower()] * 2
+        counts = Counter(zlib.crc32(term.encode()) & (RADIO_FEATURES - 1) for term in terms)
+        norm = math.sqrt(sum(count * count for count in counts.values())) or 1
+        return {bucket: count / norm for bucket, count in counts.items()}
+
+    def add(self, video_id, title, url, channel=None):
+        with self.lock:
+            self.insert(video_id, title, url, channel)
+
+    def add_many(self, entries):
+        with self.lock:
+            for video_id, title, url, channel in entries:
+                self.insert(video_id, title, url, channel)
+
+    # Called with the lock held
+    def insert(self, video_id, title, url, channel):
+        if not title or title == url:
+            return
+        row = self.rows.get(video_id)
+        if row is not None:
+            _, old_title, _, old_channel, _ = self.docs[row]
+            channel = channel or old_channel
+            if old_title == title and old_channel == channel:
+                return
+            self.remove(row)
+        terms = self.get_terms(title, channel)
+        row = len(self.docs)
+        postings = self.postings
+        document_counts = self.document_counts
+        for bucket, weight in terms.items():
+            posting = postings.get(bucket)
+            if posting is None:
+                posting = postings[bucket] = (array.array('i'), array.array('f'))
+            posting[0].append(row)
+            posting[1].append(weight)
+            document_counts[bucket] = document_counts.get(bucket, 0) + 1
+        self.docs.append((video_id, title, url, channel, terms))
+        self.alive.append(1)
+        self.rows[video_id] = row
+        self.live += 1
+
+    def remove(self, row):
+        for bucket in self.docs[row][4]:
+            self.document_counts[bucket] -= 1
+        self.docs[row] = None
+        self.alive[row] = 0
+        self.live -= 1
+
+    # Best matches for the seed tracks, most recent seed weighted highest; returns [(title, url)]
+    def similar(self, seed_ids, exclude_ids, count):
+        numpy = self.numpy
+        with self.lock:
+            query = Counter()
+            for weight, video_id in zip((1.0, 0.6, 0.35), seed_ids):
+                row = self.rows.get(video_id)
+                if row is not None:
+                    for bucket, term_weight in self.docs[row][4].items():
+                        query[bucket] += weight * term_weight
+            if not query:
+                return []
+            scores = numpy.zeros(len(self.docs), dtype=numpy.float32)
+            for bucket, query_weight in query.items():
+                document_count = self.document_counts.get(bucket, 0)
+                if not document_count or document_count > max(1000, self.live * RADIO_COMMON_TERMS):
+                    continue
+                idf = math.log((1 + self.live) / (1 + document_count)) + 1
+                rows, weights = self.postings[bucket]
+                # Views into the arrays are temporaries, so none outlives the lock and blocks a later append
+                scores[numpy.frombuffer(rows, dtype=numpy.int32)] += numpy.frombuffer(weights, dtype=numpy.float32) * (query_weight * idf * idf)
+            scores[numpy.frombuffer(self.alive, dtype=numpy.uint8) == 0] = 0
+            excluded_songs = set()
+            for video_id in exclude_ids:
+                row = self.rows.get(video_id)
+                if row is not None:
+                    scores[row] = 0
+                    excluded_songs.add(get_song_key(self.docs[row][1]))
+            candidates = min(len(scores), (count + RADIO_CHOICES) * 4)
+            top = numpy.argpartition(-scores, candidates - 1)[:candidates]
+            ranked = [(float(scores[row]), self.docs[row]) for row in top[numpy.argsort(-scores[top])] if scores[row] > 0]
+        picks = []
+        for _ in range(count):
+            ranked = [(score, doc) for score, doc in ranked if get_song_key(doc[1]) not in excluded_songs]
+            if not ranked:
+                break
+            choices = ranked[:RADIO_CHOICES]
+            score, doc = random.choices(choices, weights=[score for score, _ in choices])[0]
+            excluded_songs.add(get_song_key(doc[1]))
+            picks.append((doc[1], doc[2]))
+        return picks
+
+# Other uploads of a song, live versions and lyric videos included, count as the same song
+def get_song_key(title):
+    return ' '.join(re.sub(r'\([^)]*\)|\[[^\]]*\]', ' ', transliterate(title).lower()).split())
+
+RADIO_SOURCE_SQL = '''
+    SELECT video_id, title, url, channel FROM tracks
+    UNION ALL
+    SELECT DISTINCT video_id, title, url, NULL FROM play_history WHERE title != url AND video_id NOT IN (SELECT video_id FROM tracks)
+    UNION ALL
+    SELECT video_id, title, url, NULL FROM songs WHERE title != url AND video_id NOT IN (SELECT video_id FROM tracks)
+'''
+
+def build_radio_index():
+    global radio_index, radio_index_building
+    try:
+        started = time.perf_counter()
+        index = SimilarityIndex()
+        cursor = get_db().cursor()
+        cursor.execute(RADIO_SOURCE_SQL)
+        index.add_many(cursor)
+        radio_index = index
+        record_span('radio index build', started)
+        post_event(fill_radio_queue, True)
+    except ImportError as e:
+        print(f"Radio needs numpy: {e}")
+        post_event(set_radio, False)
+    except Exception as e:
+        print(f"Error building radio index: {e}")
+        post_event(set_radio, False)
+    finally:
+        radio_index_building = False
+
+def get_radio_seeds():
+    played = state.playlist.tracks[:state.playlist.position - state.playlist.trimmed]
+    seeds = [track.video_id for track in reversed(played[-3:])]
+    if seeds:
+        return seeds
+    try:
+        cursor = get_db().cursor()
+        cursor.execute('SELECT video_id FROM play_history ORDER BY started_at DESC LIMIT 3')
+        return [row[0] for row in cursor.fetchall()]
+    except Exception as e:
+        print(f"Error reading play history: {e}")
+        return []
+
+def get_recent_video_ids():
+    recent = {track.video_id for track in state.playlist.tracks}
+    recent.update(track.video_id for track in state.playlist.queue)
+    try:
+        cursor = get_db().cursor()
+        cursor.execute('SELECT video_id FROM play_history ORDER BY started_at DESC LIMIT 100')
+        recent.update(row[0] for row in cursor.fetchall())
+    except Exception as e:
+        print(f"Error reading play history: {e}")
+    return recent
+
+# Called as each track starts: top the queue up while it is short, so prefetch resolves the picks in time.
+# With start set, an idle player also begins playing the first pick.
+def fill_radio_queue(start=False):
+    global radio_index_building
+    if not state.radio:
+        return
+    if radio_index is None:
+        if not radio_index_building:
+            radio_index_building = True
+            job_executor.submit(build_radio_index)
+        return
+    wanted = RADIO_LOOKAHEAD - len(state.playlist.upcoming(RADIO_LOOKAHEAD))
+    if wanted <= 0:
+        return
+    seeds = get_radio_seeds()
+    with timed('radio pick'):
+        picks = radio_index.similar(seeds, get_recent_video_ids(), wanted)
+    for title, url in picks:
+        state.playlist.queue.append(get_track(title, url, 'radio'))
+    if not picks and not state.playlist.has_next():
+        print("Radio found nothing similar left to play." if seeds else "Play a song first so radio has something to go on.")
+    elif picks and start and not is_busy() and not is_paused():
+        play_next_song()
+    elif picks and start:
+        schedule_prefetch()
+
+def set_radio(enabled):
+    state.radio = enabled
+    if enabled:
+        print("Radio on: when the queue runs out, songs similar to what you have been playing come next.")
+        fill_radio_queue(start=True)
+        return
+    # Picks not played yet leave with the radio. Radio never picks a queued video, and queueing a pick by hand
+    # changes its source, so anything still marked as radio's is one of its own.
+    state.playlist.queue = deque(track for track in state.playlist.queue if track.source != 'radio')
+    print("Radio off.")
+
+def get_playlist_id(playlist_url):
+    list_ids = urllib.parse.parse_qs(urllib.parse.urlparse(playlist_url).query).get('list')
+    return list_ids[0] if list_ids else playlist_url.split("list=")[-1]
+
+# Playlist cache
+@timed('db playlist cache read')
+def get_cached_playlist(playlist_id):
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('SELECT name, page_etag, info_etag, videos, fetched_at FROM playlist_cache WHERE playlist_id = ?', (playlist_id,))
+        row = cursor.fetchone()
+        if row:
+            videos = [get_track(video['title'], video['url'], 'playlist') for video in json.loads(row[3])]
+            return {'name': row[0], 'page_etag': row[1], 'info_etag': row[2], 'videos': videos, 'fetched_at': row[4]}
+    except Exception as e:
+        print(f"Error reading playlist cache: {e}")
+    return None
+
+@timed('db playlist cache write')
+def cache_playlist(playlist_id, name, page_etag, info_etag, videos):
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('INSERT OR REPLACE INTO playlist_cache (playlist_id, name, page_etag, info_etag, videos, fetched_at) VALUES (?, ?, ?, ?, ?, ?)',
+                       (playlist_id, name, page_etag, info_etag, json.dumps([{'title': video.title, 'url': video.url} for video in videos]), time.time()))
+        conn.commit()
+    except Exception as e:
+        print(f"Error writing playlist cache: {e}")
+
+def touch_cached_playlist(playlist_id):
+    try:
+        conn = get_db()
+        cursor = conn.cursor()
+        cursor.execute('UPDATE playlist_cache SET fetched_at = ? WHERE playlist_id = ?', (time.time(), playlist_id))
+        conn.commit()
+    except Exception as e:
+        print(f"Error writing playlist cache: {e}")
+
+def fetch_playlist_page(playlist_id, page_token=None, etag=None):
+    response = get_youtube().list(
+        'playlistItems',
+        etag=etag,
+        part="snippet",
+        playlistId=playlist_id,
+        maxResults=50,
+        pageToken=page_token
+    )
+    # Filter out unavailable videos
+    items = [item for item in response['items'] if 'Deleted video' not in item['snippet']['title'] and 'Private video' not in item['snippet']['title']]
+    videos = [get_track(item['snippet']['title'], f"https://www.youtube.com/watch?v={item['snippet']['resourceId']['videoId']}", 'playlist') for item in items]
+    return videos, response.get('nextPageToken'), response.get('etag')
+
+def fetch_playlist_info(playlist_id, etag=None):
+    response = get_youtube().list(
+        'playlists',
+        etag=etag,
+        part="snippet,contentDetails",
+        id=playlist_id
+    )
+    return response['items'][0]['snippet']['title'], response.get('etag')
+
+def is_not_modified(future):
+    from googleapiclient.errors import HttpError
+    error = future.exception()
+    return isinstance(error, HttpError) and error.resp.status == 304
+
+# Keep extending the list returned to the caller while playback of the first page runs
+def load_remaining_playlist_pages(playlist_id, playlist_name, page_etag, info_etag, videos, page_token):
+    try:
+        all_videos = list(videos)
+        while page_token:
+            page, page_token, _ = fetch_playlist_page(playlist_id, page_token)
+            all_videos.extend(page)
+            post_event(extend_playlist, videos, page)
+        cache_playlist(playlist_id, playlist_name, page_etag, info_etag, all_videos)
+        print(f"Loaded all {len(all_videos)} songs from playlist: {playlist_name}")
+    except Exception as e:
+        print(f"Error loading remaining playlist pages: {e}")
+
+def extract_playlist_videos(playlist_url):
+    cached = None
+    try:
+        playlist_id = get_playlist_id(playlist_url)
+        cached = get_cached_playlist(playlist_id)
+        if cached and (time.time() - cached['fetched_at'] < config['playlist_cache_ttl'] or get_youtube().is_budget_low('playlistItems')):
+            return cached['name'], cached['videos']
+        # Revalidate a stale cache entry with ETags; the title is fetched alongside the first page
+        info_future = api_executor.submit(fetch_playlist_info, playlist_id, cached and cached['info_etag'])
+        page_future = api_executor.submit(fetch_playlist_page, playlist_id, None, cached and cached['page_etag'])
+        if cached and is_not_modified(info_future) and is_not_modified(page_future):
+            touch_cached_playlist(playlist_id)
+            return cached['name'], cached['videos']
+        playlist_name, info_etag = info_future.result() if not is_not_modified(info_future) else fetch_playlist_info(playlist_id)
+        videos, page_token, page_etag = page_future.result() if not is_not_modified(page_future) else fetch_playlist_page(playlist_id)
+        if page_token:
+            api_executor.submit(load_remaining_playlist_pages, playlist_id, playlist_name, page_etag, info_etag, videos, page_token)
+        else:
+            cache_playlist(playlist_id, playlist_name, page_etag, info_etag, videos)
+        return playlist_name, videos
+    except Exception as e:
+        if cached and is_quota_error(e):
+            print("YouTube API quota is used up; playing the cached copy of this playlist.")
+            return cached['name'], cached['videos']
+        print(f"Error extracting playlist videos: {e}")
+        return None, []
+
+def play_song_from_url(youtube_url, title=None, source='url'):
+    record_history_end()
+    if state.player:
+        state.player.stop()
+    if not title or title == youtube_url:
+        details = get_track_details(get_video_id(youtube_url) or youtube_url)
+        title = details[0] if details else None
+    song = get_track(title or youtube_url, youtube_url, source)  # The URL stands in for the title until metadata arrives
+    state.playlist.jump(state.playlist.append(song))
+    start_song(song)
+
+# Update display function
+def get_current_song():
+    if state.media is not None:
+        return state.playlist.current()
+    return None
+
+def progress_bar(current_time, length):
+    # The length is 0 until VLC has buffered enough of the stream to know it
+    filled = (current_time * 10) // length if length > 0 else 0
+    filled = min(filled, 10)
+    return f"━{'━' * filled}❍{'━' * (10 - filled)}"
+
+def update_display():
+    song = get_current_song()
+    if song:
+        current_time = max(state.time_ms, 0) // 1000
+        length = max(state.length_ms, 0) // 1000
+        volume = state.volume or 0
+        song_title = song.title
+        duration = f"-{length // 60}:{length % 60:02d}" if length else "--:--"
+        elapsed = f"{current_time // 60}:{current_time % 60:02d}"
+
+        volume_bar = '▁▂▃▄▅▆▇'
+        volume_level = volume_bar[:volume * len(volume_bar) // 100]
+
+        display_text = f'''
+({song_title})
+{elapsed} {progress_bar(current_time, length)} {duration}
+              ↻     ⊲  Ⅱ  ⊳     ↺
+VOLUME: {volume_level}
+        '''
+
+        print(display_text)
+
+# Live status line, drawn on the terminal's top row outside the scrolling region so it never touches typed input
+status_line_text = ''
+status_line_rows = 0
+
+def render_status_line(width):
+    song = get_current_song()
+    if not song:
+        text = '■ Nothing playing'
+    else:
+        current_time = max(state.time_ms, 0) // 1000
+        length = max(state.length_ms, 0) // 1000
+        icon = '▶' if state.playing else 'Ⅱ'
+        timing = f"{format_duration(current_time)} / {format_duration(length)}" if length else "buffering..."
+        suffix = f"  {timing} {progress_bar(current_time, length)}  VOL {state.volume}"
+        title = song.title[:max(0, width - len(suffix) - 3)]
+        text = f"{icon} {title}{suffix}"
+    return text[:width - 1]
+
+def draw_status_line():
+    global status_line_text, status_line_rows
+    columns, rows = shutil.get_terminal_size()
+    if rows != status_line_rows:
+        # Reserve row 1 by limiting scrolling to the rows below it
+        sys.stdout.write(f"\x1b7\x1b[2;{rows}r\x1b8")
+        status_line_rows = rows
+        status_line_text = ''
+    text = render_status_line(columns)
+    if text == status_line_text:
+        return
+    # Redraw from the first changed character onwards
+    start = 0
+    while start < min(len(text), len(status_line_text)) and text[start] == status_line_text[start]:
+        start += 1
+    if any(unicodedata.east_asian_width(char) in 'WF' for char in text[:start]):
+        start = 0  # Wide characters make the column offset unreliable
+    sys.stdout.write(f"\x1b7\x1b[1;{start + 1}H{text[start:]}\x1b[K\x1b8")
+    sys.stdout.flush()
+    status_line_text = text
+
+def run_status_line():
+    interval = 1 / config['status_refresh_rate']
+    while True:
+        try:
+            draw_status_line()
+        except Exception:
+            pass
+        time.sleep(interval)
+
+def start_status_line():
+    if not config['live_status'] or config['status_refresh_rate'] <= 0 or not sys.stdout.isatty():
+        return
+    atexit.register(lambda: sys.stdout.write("\x1b7\x1b[r\x1b8"))
+    threading.Thread(target=run_status_line, name='status-line', daemon=True).start()
+
+def display_now_playing(title, url):
+    ascii_art = f'''
+  ______ _ _       _                                       
+ |  ____(_) |     | |                                      
+ | |__   _| | ___ | |__   ___ _ __                          
+ |  __| | | |/ _ \\| '_ \\ / _ \\ '__|                         
+ | |    | | | (_) | |_) |  __/ |                            
+ |_|    |_|_|\\___/|_.__/ \\___|_|                            
+                                                           
+ _   _  ____  _     _____ ____  _        _     _____ ____  
+| | | |/ __ \\| |   |_   _|  _ \\| |      | |   |_   _/ __ \\ 
+| | | | |  | | |     | | | |_) | |      | |     | || |  | |
+| | | | |  | | |     | | |  _ <| |      | |     | || |  | |
+| |_| | |__| | |_____| |_| |_) | |____  | |_____| || |__| |
+ \\___/ \\____/|______|_____|____/|______| |______|____\\____/ 
+                                                           
+Now playing: {title} ({url})
+'''
+    print(ascii_art)
+    details = get_track_details(get_video_id(url) or url)
+    if details and (details[1] or details[2]):
+        print(f"Channel: {details[1] or 'unknown'}   Duration: {format_duration(details[2]) if details[2] else '--:--'}")
+
+# Event loop
+def post_event(callback, *args):
+    events.put((callback, args))
+
+def run_event_loop():
+    while True:
+        callback, args = events.get()
+        try:
+            callback(*args)
+        except Exception as e:
+            print(f"An error occurred: {e}")
+
+# Run blocking work on a job thread and hand its result back to the event loop.
+# A job started by a daemon command prints into that command's reply, and the reply waits for it.
+def run_job(work, on_done, *args):
+    capture = getattr(output_local, 'capture', None)
+    if capture is not None:
+        capture.start_job()
+    def job():
+        output_local.capture = capture
+        try:
+            result = work(*args)
+        except Exception as e:
+            print(f"An error occurred: {e}")
+            if capture is not None:
+                capture.finish_job()
+            return
+        finally:
+            output_local.capture = None
+        post_event(run_captured, capture, on_done, result)
+    job_executor.submit(job)
+
+# Pending search results belong to whoever searched: the local prompt, or one daemon connection
+def get_search_owner():
+    capture = getattr(output_local, 'capture', None)
+    return capture.owner if capture is not None else state
+
+def show_search_results(results):
+    for i, result in enumerate(results):
+        print(f"{i+1}. {result['title']} ({result['url']})")
+    if results:
+        get_search_owner().search_results = results
+        print("Select a song (1-5) or type 'close' to exit:")
+    else:
+        print("No songs found.")
+
+def select_search_result(selection):
+    owner = get_search_owner()
+    if selection.lower() == 'close':
+        owner.search_results = None
+        print("Song selection closed.")
+        return
+    try:
+        selection = int(selection) - 1
+    except ValueError:
+        print("Invalid input. Please enter a number between 1 and 5 or type 'close' to exit.")
+        return
+    if not 0 <= selection < len(owner.search_results):
+        print("Invalid selection. Please enter a number between 1 and 5.")
+        return
+    result = owner.search_results[selection]
+    new_song = get_track(result['title'], result['url'], 'search')
+    owner.search_results = None
+    if is_busy():
+        state.playlist.queue.append(new_song)
+        print("New song added to the queue.")
+        schedule_prefetch()
+    else:
+        record_history_end()
+        if state.player:
+            state.player.stop()
+        state.playlist.jump(state.playlist.append(new_song))
+        start_song(new_song)
+
+def start_playlist(result):
+    playlist_name, videos = result
+    if videos:
+        state.playlist.load(videos)
+        state.playlist_mode = True
+        print(f"Playlist: {playlist_name}")
+        for i, song in enumerate(videos):
+            print(f"{i+1}. {song.title} ({song.url})")
+        play_next_song()
+        resolve_playlist_ahead(videos[1:])
+    else:
+        print("Error: Could not load playlist.")
+
+# Pages of a long playlist arrive while it plays; resolve them as they come in
+def extend_playlist(videos, page):
+    already_resolving = len(videos) - 1
+    videos.extend(page)
+    limit = config['batch_resolve_limit']
+    if videos is state.playlist.tracks and (not limit or already_resolving < limit):
+        resolve_playlist_ahead(page[:limit - already_resolving] if limit else page)
+
+# Session journal: changes to the play order, cursor and position are appended to a JSON-lines file about once a second
+# from the event loop and written by a background thread, so a crash loses at most the last second of the session.
+# Each record carries only the keys that changed; every SESSION_JOURNAL_COMPACT_AFTER records the file is replaced
+# by one snapshot. Resolved stream URLs and playlist pages stay in their database caches and are only read again
+# when a restored track is played.
+SESSION_KEYS = ('trimmed', 'position', 'queue', 'time', 'playlist_mode', 'radio', 'volume')
+journal_writes = Queue()
+journal_writer = None
+journal_records = SESSION_JOURNAL_COMPACT_AFTER  # Starts full so the first change replaces the previous session's journal
+journaled = None  # The state the journal describes, compared against the live state on every check
+
+def encode_track(track):
+    return [track.title, track.url, track.source]
+
+def get_session_time():
+    if state.restore_ms is not None:
+        return state.restore_ms
+    if state.loading:
+        return None  # The next stream has not opened yet; its position is not known
+    return state.time_ms if state.media is not None else 0
+
+def get_journal_view():
+    playlist = state.playlist
+    return {'playlist': playlist, 'tracks': playlist.tracks, 'length': len(playlist), 'trimmed': playlist.trimmed,
+            'position': playlist.position, 'queue': list(playlist.queue), 'time': get_session_time(),
+            'playlist_mode': state.playlist_mode, 'radio': state.radio, 'volume': state.volume}
+
+def journal_session():
+    global journaled, journal_records
+    was = journaled
+    now = get_journal_view()
+    # Closing the player, or changing settings before anything plays, leaves the last session in place for 'restore'
+    if not now['tracks'] and not now['queue']:
+        return
+    if now['time'] is None:
+        now['time'] = 0 if now['position'] != was['position'] else was['time']
+    reload = now['playlist'] is not was['playlist'] or now['tracks'] is not was['tracks'] \
+        or not was['trimmed'] <= now['trimmed'] <= was['length']
+    changed = [key for key in SESSION_KEYS if now[key] != was[key]]
+    # Playback moving on is only worth a record once it has moved a whole second
+    if changed == ['time'] and abs(now['time'] - was['time']) < 1000:
+        changed = []
+    if not reload and not changed and now['length'] == was['length']:
+        return
+    record = {}
+    if reload or journal_records >= SESSION_JOURNAL_COMPACT_AFTER:
+        record['load'] = [encode_track(track) for track in now['tracks']]
+        changed = SESSION_KEYS
+    elif now['length'] > was['length']:
+        # Played tracks trimmed off the front are dropped on replay after the new ones are added
+        record['extend'] = [encode_track(track) for track in now['tracks'][was['length'] - now['trimmed']:]]
+    for key in changed:
+        record[key] = now[key]
+    if 'queue' in record:
+        record['queue'] = [encode_track(track) for track in record['queue']]
+    if 'load' in record:
+        journal_records = 0
+        write_journal('snapshot', record)
+    else:
+        journal_records += 1
+        write_journal('append', record)
+    journaled = now
+
+def write_journal(kind, record):
+    global journal_writer
+    if journal_writer is None:
+        journal_writer = threading.Thread(target=run_journal_writer, name='journal-writer', daemon=True)
+        journal_writer.start()
+    journal_writes.put((kind, record))
+
+def run_journal_writer():
+    global journal_records
+    path = config['session_journal']
+    file = None
+    while True:
+        kind, record = journal_writes.get()
+        try:
+            if kind == 'flush':
+                if file:
+                    file.flush()
+                record.set()
+                continue
+            line = json.dumps(record, separators=(',', ':')) + '\n'
+            if kind == 'snapshot':
+                # Written aside and swapped in, so a crash mid-compaction still leaves the old journal whole
+                if file:
+                    file.close()
+                    file = None
+                with open(path + '.tmp', 'w', encoding='utf-8') as snapshot:
+                    snapshot.write(line)
+                    snapshot.flush()
+                    os.fsync(snapshot.fileno())
+                os.replace(path + '.tmp', path)
+                file = open(path, 'a', encoding='utf-8')
+            elif file:
+                file.write(line)
+            if file and journal_writes.empty():
+                file.flush()
+        except Exception as e:
+            print(f"Error writing session journal: {e}")
+            journal_records = SESSION_JOURNAL_COMPACT_AFTER  # Appends are dropped until the next snapshot succeeds
+
+def run_journal_ticker():
+    while True:
+        time.sleep(SESSION_JOURNAL_INTERVAL)
+        post_event(journal_session)
+
+def start_session_journal(restore):
+    global journaled
+    if not config['session_journal']:
+        return
+    journaled = get_journal_view()
+    if restore:
+        restore_session(play=False)
+    threading.Thread(target=run_journal_ticker, name='journal-ticker', daemon=True).start()
+
+def flush_journal_writes(done):
+    if journal_writer is None:
+        done.set()
+    else:
+        journal_writes.put(('flush', done))
+
+# Record the final position on the way out
+def flush_session_journal(timeout=2):
+    if journaled is None:
+        return
+    done = threading.Event()
+    post_event(journal_session)
+    post_event(flush_journal_writes, done)
+    done.wait(timeout)
+
+atexit.register(flush_session_journal)
+
+# Replays the journal; a last line torn by a crash is ignored, since every line before it is complete
+@timed('session journal read')
+def read_session_journal():
+    session = {'tracks': [], 'trimmed': 0, 'position': 0, 'queue': [], 'time': 0, 'playlist_mode': False, 'radio': False, 'volume': None}
+    try:
+        with open(config['session_journal'], encoding='utf-8') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if 'load' in record:
+                    session['tracks'] = record['load']
+                    session['trimmed'] = record['trimmed']
+                session['tracks'].extend(record.get('extend', ()))
+                if 'trimmed' in record:
+                    del session['tracks'][:record['trimmed'] - session['trimmed']]
+                session.update((key, record[key]) for key in SESSION_KEYS if key in record)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Error reading session journal: {e}")
+        return None
+    return session
+
+def restore_session(play=True):
+    started = time.perf_counter()
+    session = read_session_journal() if config['session_journal'] else None
+    if not session or not (session['tracks'] or session['queue']):
+        if play:
+            print("No saved session to restore.")
+        return
+    record_history_end()
+    if state.player:
+        state.player.stop()
+    state.play_request += 1  # Drop anything still resolving for the session being replaced
+    state.loading = False
+    cancel_prefetch()
+    playlist = Playlist([get_track(*track) for track in session['tracks']])
+    playlist.trimmed = session['trimmed']
+    playlist.position = session['position']
+    playlist.queue = deque(get_track(*track) for track in session['queue'])
+    state.playlist = playlist
+    state.playlist_mode = session['playlist_mode']
+    state.radio = session['radio']
+    if session['volume'] is not None:
+        state.volume = session['volume']
+        if state.player:
+            state.player.audio_set_volume(state.volume)
+    song = playlist.current()
+    record_span('session restore', started)
+    print(f"Restored your last session: {len(playlist) - playlist.trimmed} songs and {len(playlist.queue)} queued "
+          f"in {(time.perf_counter() - started) * 1000:.0f} ms.")
+    if song is None:
+        print("Type 'next' to continue.")
+    elif play:
+        start_song(song, on_failure=play_next_song, start_ms=session['time'])
+    else:
+        state.restore_ms = session['time']
+        print(f"Next up: {song.title} at {format_duration(session['time'] // 1000)}. Type 'resume' to continue.")
+    update_display()
+
+# Command handlers
+def handle_command(command):
+    if get_search_owner().search_results is not None:
+        select_search_result(command.strip())
+        return
+    parts = command.split()
+    cmd = parts[0]
+    args = parts[1:]
+
+    def is_playing():
+        if not state.player or not state.player.is_playing():
+            print(f"Command '{cmd}' cannot be used when no song is playing.")
+            return False
+        return True
+
+    if cmd == 'play' or cmd == 'play!':
+        if state.playlist_mode:
+            print("Cannot add songs to the playlist. Please type 'close' to exit the playlist mode.")
+        else:
+            query = " ".join(args)
+            if "youtube.com/watch?v=" in query:
+                play_song_from_url(query)
+            elif cmd == 'play!':
+                run_job(functools.partial(search_youtube, refresh=True), show_search_results, query)
+            else:
+                local_results = search_local(query)
+                if local_results:
+                    print(f"Found in your library (type 'play! {query}' to search YouTube):")
+                    show_search_results(local_results)
+                else:
+                    run_job(search_youtube, show_search_results, query)
+    elif cmd == 'pp':
+        playlist_url = args[0]
+        run_job(extract_playlist_videos, start_playlist, playlist_url)
+    elif cmd == 'fav':
+        song = state.playlist.current()
+        if song:
+            add_favorite(song.title, song.url)
+        else:
+            print("No song is currently playing to add to favorites.")
+    elif cmd == 'favlist':
+        list_favorites()
+    elif cmd == 'favr' or cmd == 'fr':
+        if len(args) > 0:
+            try:
+                song_id = int(args[0])
+                remove_from_favorites(song_id)
+            except ValueError:
+                print("Invalid song ID.")
+        else:
+            print("Please provide a song ID to remove from favorites.")
+    elif cmd == 'favplay':
+        if len(args) > 0:
+            try:
+                song_id = int(args[0])
+                play_favorite_by_id(song_id)
+            except ValueError:
+                print("Invalid song ID.")
+        else:
+            print("Please provide a song ID to play from favorites.")
+    elif cmd == 'pf':
+        play_favorites()
+    elif cmd == 'favimport':
+        if len(args) > 0:
+            run_job(import_favorites, show_import_result, " ".join(args))
+        else:
+            print("Please provide a JSONL or M3U file or a playlist URL. Usage: favimport <file|playlist URL>")
+    elif cmd == 'favexport':
+        if len(args) > 0:
+            run_job(export_favorites, show_export_result, " ".join(args))
+        else:
+            print("Please provide a file to export to. Usage: favexport <file>")
+    elif cmd == 'next':
+        if len(state.playlist) or state.playlist.queue:
+            if len(args) > 0:
+                song_index = int(args[0])
+                if state.playlist.has_position(song_index):
+                    play_next_song(song_index)
+                else:
+                    print("Invalid song number.")
+            else:
+                play_next_song()
+        else:
+            print("No next song available.")
+    elif cmd == 'previous' or cmd == 'prev':
+        if len(state.playlist) or state.playlist.queue:
+            play_previous_song()
+        else:
+            print("No previous song available.")
+    elif cmd == 'vol' or cmd == 'volume':
+        volume = int(args[0])
+        if 0 <= volume <= 100:
+            if state.player:
+                old_volume = state.volume
+                state.player.audio_set_volume(volume)
+                state.volume = volume
+                print(f"Volume set from {old_volume} to {volume}.")
+            else:
+                print("No song is currently playing to set volume.")
+        else:
+            print("Volume must be between 0 and 100.")
+    elif cmd == 'seek':
+        if len(args) > 0:
+            try:
+                seek_value = int(args[0])
+                if is_playing():
+                    length = state.length_ms // 1000  # Get length in seconds
+                    if 0 <= seek_value <= length:
+                        state.player.set_time(seek_value * 1000)  # Seek in milliseconds
+                        print(f"Seeked to {seek_value} seconds.")
+                        update_display()
+                    else:
+                        print(f"Invalid seek time. Please enter a value between 0 and {length} seconds.")
+            except ValueError:
+                print("Invalid input. Please enter the number of seconds to seek.")
+        else:
+            print("Please provide the number of seconds to seek. Usage: seek <seconds>")
+    elif cmd == 'repeat' or cmd == 'replay':
+        if state.player:
+            state.player.set_time(0)
+            state.player.play()
+            print("Song replayed.")
+            update_display()
+        else:
+            print("No song is currently playing to repeat.")
+    elif cmd == 'now':
+        song = state.playlist.current()
+        if song:
+            display_now_playing(song.title, song.url)
+            update_display()
+        else:
+            print("No song is currently playing.")
+    elif cmd == 'pause':
+        if state.player and state.player.is_playing():
+            state.paused_time = state.time_ms
+            state.player.pause()
+            if state.history_entry:
+                state.history_entry['paused_at'] = time.time()
+            print("Playback paused.")
+            update_display()
+        else:
+            print("No song is currently playing to pause.")
+    elif cmd == 'resume':
+        if state.restore_ms is not None and state.media is None:
+            start_song(state.playlist.current(), on_failure=play_next_song, start_ms=state.restore_ms)
+        elif state.player:
+            if state.history_entry and state.history_entry['paused_at']:
+                state.history_entry['paused_total'] += time.time() - state.history_entry['paused_at']
+                state.history_entry['paused_at'] = None
+            if is_stream_expired():
+                # Seeking a paused stream whose URL has expired fails; fetch a fresh URL and reopen at the same spot
+                print("The paused stream is no longer valid, reopening it...")
+                recover_stream(state.paused_time)
+            else:
+                state.player.set_time(state.paused_time)
+                state.player.play()
+                state.last_progress = time.perf_counter()
+                print("Playback resumed.")
+                update_display()
+        else:
+            print("No song is currently paused to resume.")
+    elif cmd == 'stop':
+        if state.player and state.player.is_playing():
+            record_history_end()
+            state.player.stop()
+            print("Playback stopped.")
+            update_display()
+        else:
+            print("No song is currently playing to stop.")
+    elif cmd == 'close':
+        if state.player or state.loading or state.restore_ms is not None:
+            record_history_end()
+            if state.player and state.player.is_playing():
+                state.player.stop()
+            if state.player:
+                state.player.release()
+            state.player = None
+            state.play_request += 1
+            state.loading = False
+            state.request_started = state.media_started = state.track_ended_at = None
+            if state.media:
+                state.media.release()
+            state.media = None
+            release_preloaded_media()
+            state.playlist = Playlist()
+            state.paused_time = 0
+            state.playlist_mode = False
+            state.restore_ms = None
+            cancel_prefetch()
+            print("Player closed.")
+            update_display()
+        else:
+            print("No song is currently playing to close.")
+    elif cmd == 'playlist' and args[0] == 'restart':
+        if state.playlist.tracks:
+            play_next_song(state.playlist.trimmed + 1)
+        else:
+            print("Cannot restart. No playlist loaded.")
+    elif cmd == 'last':
+        if len(args) > 0:
+            try:
+                play_from_history(int(args[0]))
+            except ValueError:
+                print("Invalid history position.")
+        else:
+            play_last_played()
+    elif cmd == 'history':
+        try:
+            list_history(int(args[0]) if args else 10)
+        except ValueError:
+            print("Invalid number of songs.")
+    elif cmd == 'top':
+        period = args[0] if args else 'week'
+        if period in HISTORY_PERIODS:
+            list_top_songs(period)
+        else:
+            print(f"Invalid period. Use one of: {', '.join(HISTORY_PERIODS)}.")
+    elif cmd == 'session':
+        if state.player and state.player.is_playing():
+            song = state.playlist.current()
+            current_time = state.time_ms // 1000
+            length = state.length_ms // 1000
+            print(f"Currently playing: {song.title} ({song.url})")
+            print(f"Time: {current_time} seconds / {length} seconds")
+        else:
+            print("No song is currently playing.")
+    elif cmd == 'restore':
+        restore_session()
+    elif cmd == 'stats':
+        if args and args[0] == 'reset':
+            with stage_timings_lock:
+                stage_timings.clear()
+            print("Timings cleared.")
+        else:
+            display_stats()
+    elif cmd == 'quota':
+        display_quota()
+    elif cmd == 'radio':
+        if args and args[0] not in ('on', 'off'):
+            print("Usage: radio [on|off]")
+        else:
+            set_radio(args[0] == 'on' if args else not state.radio)
+    elif cmd == 'config':
+        print(yaml.dump(config))
+    elif cmd == 'help':
+        display_help()
+
+# Load everything the first play needs while the user is still typing
+def warm_up():
+    try:
+        started = time.perf_counter()
+        get_db()
+        started = record_startup('database', started)
+        get_youtube()
+        started = record_startup('youtube client', started)
+        import yt_dlp
+        started = record_startup('yt_dlp import', started)
+        get_vlc_instance()
+        record_startup('vlc instance', started)
+        backfill_metadata()
+    except Exception as e:
+        print(f"Error warming up: {e}")
+
+def display_startup_profile():
+    print("Startup profile:")
+    for label, milliseconds in startup_timings:
+        print(f"  {label:<16}{milliseconds:8.1f} ms")
+
+# Daemon mode: one resident player controlled over a Unix domain socket.
+# Each line on the socket is a JSON object; requests carry an 'op' and an optional 'id' echoed in the response:
+#   {"op": "command", "command": "<any interactive command>"}  -> {"ok": true, "output": "<what it printed>"}
+#   {"op": "status"}, {"op": "subscribe" | "unsubscribe", "topics": [...]}, {"op": "shutdown"}
+# Subscribers receive {"event": "track" | "position" | "output", ...} lines as things happen.
+CONTROL_TOPICS = ('track', 'position', 'output')
+COMMAND_OUTPUT_TIMEOUT = 60  # Seconds a command reply waits for the searches and loads it started
+control_clients = set()
+control_lock = threading.Lock()
+output_local = threading.local()
+control_server = None
+
+# Sends printed text to the command being answered on this thread, or to 'output' subscribers
+class OutputRouter:
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        capture = getattr(output_local, 'capture', None)
+        if capture is None or not capture.append(text):
+            self.stream.write(text)
+            # print() writes the text and its newline separately; subscribers get whole lines
+            lines, newline, rest = (getattr(output_local, 'partial', '') + text).rpartition('\n')
+            output_local.partial = rest
+            if lines.strip():
+                publish('output', {'text': lines + newline})
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+def publish(topic, payload):
+    if not control_clients:
+        return
+    with control_lock:
+        subscribers = [client for client in control_clients if topic in client.topics]
+    for client in subscribers:
+        client.send(dict(payload, event=topic))
+
+def get_status():
+    song = get_current_song()
+    return {
+        'title': song.title if song else None,
+        'url': song.url if song else None,
+        'time_ms': max(state.time_ms, 0),
+        'length_ms': max(state.length_ms, 0),
+        'playing': state.playing,
+        'volume': state.volume,
+        'loading': state.loading,
+    }
+
+# What one control command prints, including the jobs it starts and the work they hand back to the event loop
+class CommandCapture:
+    def __init__(self, owner):
+        self.owner = owner  # The connection that sent the command
+        self.buffer = []
+        self.jobs = 0
+        self.closed = False  # Replied; anything printed later goes to subscribers instead
+        self.lock = threading.Lock()
+        self.idle = threading.Event()
+
+    def append(self, text):
+        with self.lock:
+            if not self.closed:
+                self.buffer.append(text)
+            return not self.closed
+
+    def start_job(self):
+        with self.lock:
+            self.jobs += 1
+            self.idle.clear()
+
+    def finish_job(self):
+        with self.lock:
+            self.jobs -= 1
+            if not self.jobs:
+                self.idle.set()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            return ''.join(self.buffer)
+
+def run_captured(capture, callback, *args):
+    output_local.capture = capture
+    try:
+        callback(*args)
+    except Exception as e:
+        print(f"An error occurred: {e}")
+    finally:
+        output_local.capture = None
+        if capture is not None:
+            capture.finish_job()
+
+# Run a command on the event loop like typed input, collecting what it and its jobs print
+def run_captured_command(command, client):
+    capture = CommandCapture(client)
+    capture.start_job()
+    post_event(run_captured, capture, handle_command, command)
+    capture.idle.wait(COMMAND_OUTPUT_TIMEOUT)
+    return capture.close()
+
+def handle_control_request(client, request):
+    op = request.get('op')
+    if op == 'command':
+        command = request.get('command', '')
+        return {'ok': True, 'output': run_captured_command(command, client) if command.strip() else ''}
+    elif op == 'status':
+        return dict(get_status(), ok=True)
+    elif op in ('subscribe', 'unsubscribe'):
+        topics = set(request.get('topics', CONTROL_TOPICS))
+        unknown = topics - set(CONTROL_TOPICS)
+        if unknown:
+            return {'ok': False, 'error': f"Unknown topics: {', '.join(sorted(unknown))}"}
+        with control_lock:
+            if op == 'subscribe':
+                client.topics |= topics
+            else:
+                client.topics -= topics
+        return {'ok': True, 'topics': sorted(client.topics)}
+    elif op == 'shutdown':
+        threading.Thread(target=control_server.shutdown, daemon=True).start()
+        return {'ok': True}
+    return {'ok': False, 'error': f"Unknown op: {op}"}
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.topics = set()
+        self.search_results = None  # This connection's 'play <query>' results waiting for a selection
+        # Replies and events go through a queue so a slow client never blocks the event loop
+        self.outgoing = Queue()
+        self.writer = threading.Thread(target=self.run_writer, name='control-writer', daemon=True)
+        self.writer.start()
+
+    def send(self, message):
+        self.outgoing.put(message)
+
+    def run_writer(self):
+        while True:
+            message = self.outgoing.get()
+            if message is None:
+                return
+            try:
+                self.wfile.write((json.dumps(message, ensure_ascii=False) + '\n').encode('utf-8'))
+                self.wfile.flush()
+            except OSError:
+                return
+
+    def handle(self):
+        with control_lock:
+            control_clients.add(self)
+        try:
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    self.send({'ok': False, 'error': 'Invalid JSON'})
+                    continue
+                response = handle_control_request(self, request)
+                if 'id' in request:
+                    response['id'] = request['id']
+                self.send(response)
+        finally:
+            with control_lock:
+                control_clients.discard(self)
+
+    def finish(self):
+        self.outgoing.put(None)
+        self.writer.join(5)
+        super().finish()
+
+# Push the position model to subscribers whenever it changes
+def run_position_publisher():
+    interval = 1 / config['status_refresh_rate'] if config['status_refresh_rate'] > 0 else 1
+    last_status = None
+    while True:
+        time.sleep(interval)
+        status = get_status()
+        if status != last_status:
+            publish('position', status)
+            last_status = status
+
+def run_daemon(socket_path):
+    global control_server
+    if not hasattr(socket, 'AF_UNIX'):
+        print("Daemon mode needs Unix domain sockets, which this platform does not support.")
+        return 1
+    if os.path.exists(socket_path):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                probe.connect(socket_path)
+            print(f"A player daemon is already listening on {socket_path}.")
+            return 1
+        except OSError:
+            os.unlink(socket_path)  # Left behind by a daemon that did not shut down cleanly
+    sys.stdout = OutputRouter(sys.stdout)
+    threading.Thread(target=run_event_loop, name='event-loop', daemon=True).start()
+    post_event(start_session_journal, config['auto_restore'])
+    warm_up()
+    control_server = socketserver.ThreadingUnixStreamServer(socket_path, ControlHandler)
+    control_server.daemon_threads = True
+    os.chmod(socket_path, 0o600)
+    threading.Thread(target=run_position_publisher, name='position-publisher', daemon=True).start()
+    print(f"Player daemon listening on {socket_path}")
+    try:
+        control_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        control_server.server_close()
+        os.unlink(socket_path)
+    return 0
+
+def send_control_request(connection, request):
+    connection.sendall((json.dumps(request) + '\n').encode('utf-8'))
+
+# Thin client: runs one command and exits, or reads commands interactively while printing daemon output
+def run_client(socket_path, command):
+    try:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(socket_path)
+    except (AttributeError, OSError) as e:
+        print(f"Error connecting to the player daemon at {socket_path}: {e}")
+        return 1
+    replies = connection.makefile('r', encoding='utf-8')
+    if command:
+        send_control_request(connection, {'op': 'command', 'command': command})
+        print(json.loads(replies.readline()).get('output', ''), end='')
+        return 0
+    replied = threading.Event()
+    def print_messages():
+        for line in replies:
+            message = json.loads(line)
+            if message.get('event') == 'output':
+                print(message['text'], end='', flush=True)
+            elif 'event' not in message:
+                if message.get('error'):
+                    print(f"Error: {message['error']}")
+                print(message.get('output', ''), end='', flush=True)
+                replied.set()
+        replied.set()
+    threading.Thread(target=print_messages, name='client-reader', daemon=True).start()
+    commands = [{'op': 'subscribe', 'topics': ['output']}]
+    while True:
+        for request in commands:
+            replied.clear()
+            try:
+                send_control_request(connection, request)
+            except OSError as e:
+                print(f"Error talking to the player daemon: {e}")
+                return 1
+            replied.wait()
+        try:
+            command = input("> ")
+        except (EOFError, KeyboardInterrupt):
+            break
+        commands = [{'op': 'command', 'command': command}] if command.strip() else []
+    connection.close()
+    return 0
+
+if __name__ == "__main__":
+    if '--client' in sys.argv:
+        sys.exit(run_client(config['control_socket'], " ".join(sys.argv[sys.argv.index('--client') + 1:])))
+    if '--daemon' in sys.argv:
+        sys.exit(run_daemon(config['control_socket']))
+    display_logo()
+    threading.Thread(target=run_event_loop, name='event-loop', daemon=True).start()
+    start_status_line()
+    post_event(start_session_journal, config['auto_restore'])
+    record_startup('prompt ready', startup_started)
+    if '--profile-startup' in sys.argv:
+        warm_up()
+        display_startup_profile()
+    else:
+        threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+    while True:
+        try:
+            command = input("> ")
+            if command.strip():
+                # Wait until the loop has taken the command; network work it starts keeps running in the background
+                handled = threading.Event()
+                post_event(handle_command, command)
+                post_event(handled.set)
+                handled.wait()
+        except EOFError:
+            break
+        except Exception as e:
+            print(f"An error occurred: {e}")